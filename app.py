@@ -1,11 +1,28 @@
 import os
+import re
+import math
+import json
+import select
+import socket
 import uuid
+import heapq
+import sqlite3
+import shutil
+import hashlib
+import itertools
+import contextlib
+import functools
 import time
 import threading
-from datetime import datetime, timezone
+import subprocess
+import multiprocessing
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, jsonify, send_file, abort
+from flask import Flask, Response, request, jsonify, send_file, abort
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.http import dump_options_header
+from werkzeug.wsgi import ClosingIterator
 import yt_dlp
 
 # =========================
@@ -16,115 +33,1832 @@ HOST = "0.0.0.0"
 PORT = 80
 
 DOWNLOAD_DIR = "downloads"
-MAX_PARALLEL_DOWNLOADS = 4
+MAX_PARALLEL_DOWNLOADS = 4    # starting number of jobs downloading at once
+FRAGMENT_THREADS = 8          # starting fragment threads per job
+MERGE_WORKERS = os.cpu_count() or 2   # ffmpeg merges run in their own pool
+
+FFMPEG_PATH = "ffmpeg"
+
+# Where yt-dlp runs: "thread" (inside this process) or "process" (a pool of
+# long-lived worker processes, off the request handlers' GIL). A worker
+# process is replaced after WORKER_MAX_JOBS jobs or once its peak RSS
+# passes WORKER_MAX_RSS_BYTES.
+WORKER_MODE = "thread"
+WORKER_MAX_JOBS = 50
+WORKER_MAX_RSS_BYTES = 512 * 1024 ** 2
+WORKER_CANCEL_GRACE_SECONDS = 10   # kill a worker that ignores a cancel this long
+
+# Adaptive concurrency: every CONCURRENCY_ADJUST_SECONDS the controller
+# looks at the summed download speed and moves both knobs AIMD-style, one
+# step up while throughput keeps growing, cut back when it drops.
+ADAPTIVE_CONCURRENCY = True
+PARALLEL_DOWNLOADS_RANGE = (1, 12)   # floor, ceiling
+FRAGMENT_THREADS_RANGE = (1, 32)     # floor, ceiling
+CONCURRENCY_ADJUST_SECONDS = 15
+CONCURRENCY_GAIN = 0.05       # throughput must grow 5% to keep stepping up
+CONCURRENCY_BACKOFF = 0.20    # a 20% drop counts as congestion
+CONCURRENCY_DECREASE = 0.75   # multiply knobs by this on congestion
 
 DEFAULT_AUDIO_BITRATE = "192"
 TOKEN_EXPIRE_SECONDS = 300  # 5 minutes - give users time to download
-FILE_DELETE_SECONDS = 360   # 6 minutes - delete after token expires
+FAILED_TOKEN_EXPIRE_SECONDS = 300     # how long a failed download's error stays readable
+CANCELLED_TOKEN_EXPIRE_SECONDS = 60
+# A token whose download hasn't finished expires once nobody has asked about
+# it for this long; the download is cancelled if no other token wants it
+PENDING_TOKEN_EXPIRE_SECONDS = 600
 
+# Downloads allowed per IP in any rolling QUOTA_WINDOW_SECONDS (a sliding
+# window estimate). Only the RATE_LIMIT_MAX_KEYS most recently seen IPs are
+# tracked, so a flood of new addresses cannot grow memory without bound.
 MAX_DOWNLOADS_PER_DAY = 10
+QUOTA_WINDOW_SECONDS = 24 * 3600
+RATE_LIMIT_MAX_KEYS = 100_000
+
+MAX_BATCH_ITEMS = 50     # videos per POST /batch (and no more than MAX_DOWNLOADS_PER_DAY)
+BATCH_MAX_ACTIVE = 2     # downloads of one batch running at once
+
+# Admission control: refuse new downloads with 503 + Retry-After instead of
+# queueing without bound. The wait estimate uses recent job durations.
+MAX_QUEUE_DEPTH = 100
+MAX_ESTIMATED_WAIT_SECONDS = 900
+DEFAULT_JOB_SECONDS = 60          # assumed duration before any job finished
+
+# Watchdog: a download that makes no progress for STALL_TIMEOUT_SECONDS, or
+# runs past its deadline (JOB_DEADLINE_SECONDS plus its total_bytes at
+# JOB_MIN_BYTES_PER_SEC), is failed and its slot handed to the next job.
+STALL_TIMEOUT_SECONDS = 120
+JOB_DEADLINE_SECONDS = 300
+JOB_MIN_BYTES_PER_SEC = 100 * 1024
+WATCHDOG_SECONDS = 10
+
+NOT_JSON_MAX_WAIT_SECONDS = 3600  # give up on a not-json request after 1 hour
+DISCONNECT_CHECK_SECONDS = 2      # how often a waiting not-json request checks its client
+
+PROGRESS_MAX_WAIT_SECONDS = 60    # cap for /progress long-polling (wait=...)
+PROGRESS_STREAM_MAX_HZ = 4        # max SSE updates per second per client
+PROGRESS_STREAM_KEEPALIVE = 15    # seconds between SSE keepalive comments
+PROGRESS_PUBLISH_HZ = 4           # max yt-dlp progress samples applied per job per second
+
+STREAM_CHUNK_SIZE = 256 * 1024    # bytes read per chunk when streaming a growing file
+STREAM_POLL_SECONDS = 1           # re-check a growing file at least this often
+
+# How finished files are handed to the client:
+#   "direct"           - Flask streams the file itself
+#   "x-accel-redirect" - nginx serves it from an internal location that maps
+#                        ACCEL_REDIRECT_PREFIX onto DOWNLOAD_DIR
+#   "x-sendfile"       - Apache/lighttpd mod_xsendfile serves it by path
+DELIVERY_MODE = "direct"
+ACCEL_REDIRECT_PREFIX = "/protected-downloads/"
+
+# Finished files stay cached until disk pressure forces them out. Once usage
+# passes the high watermark, unreferenced files are evicted down to the low
+# watermark. The budget shrinks further if the disk itself runs low.
+CACHE_MAX_BYTES = 20 * 1024 ** 3       # 20 GiB
+CACHE_HIGH_WATERMARK = 0.90            # fraction of the budget
+CACHE_LOW_WATERMARK = 0.75             # fraction of the budget
+CACHE_MIN_FREE_BYTES = 2 * 1024 ** 3   # always leave this much disk free
+CACHE_EVICTION_POLICY = "lru"          # "lru" or "lfu"
+CACHE_MAX_IDLE_SECONDS = 24 * 3600     # drop files unused this long (None = never)
+CACHE_SWEEP_SECONDS = 60
+
+# Total download rate shared by all yt-dlp jobs, in bytes/sec (None = no
+# limit). Each running job gets an equal share, recomputed whenever a job
+# starts or finishes, so /download traffic on the same link keeps headroom.
+MAX_INGEST_BYTES_PER_SEC = None
+BANDWIDTH_BURST_SECONDS = 1.0          # how far a job may run ahead of its share
+
+# Tokens, job failures and quota are logged to an append-only journal and
+# replayed on startup: interrupted jobs are queued again and pick up their
+# partial files. The journal is rewritten as a snapshot now and then.
+JOURNAL_PATH = "journal.jsonl"
+JOURNAL_FSYNC = False                  # fsync each batch of records (survives power loss)
+JOURNAL_COMPACT_SECONDS = 3600
+QUOTA_JOURNAL_SECONDS = 1              # quota changes are journaled in batches this often
+
+# Where job, token and quota state lives: "memory" (this process only) or
+# "sqlite" (a database file every worker process on the host shares, so the
+# app can run under e.g. several gunicorn workers). With "sqlite" the
+# database is the durable record instead of the journal, and the jobs of a
+# process that stops heartbeating for STATE_STALE_SECONDS are taken over.
+STATE_BACKEND = "memory"
+STATE_DB_PATH = "state.db"
+STATE_SYNC_SECONDS = 1       # how often progress is shared between processes
+STATE_STALE_SECONDS = 30
+
+ADMIN_IPS = ("127.0.0.1", "::1")       # allowed to call /admin/*
+
+# =========================
+# Housekeeping Scheduler
+# =========================
+
+class Scheduler:
+    """One thread running every timed job (token expiry, file deletion, ...).
+
+    Entries are keyed so they can be cancelled or rescheduled; scheduling a
+    key that is already pending moves it to the new time.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []      # (when, seq, key), may hold stale entries
+        self._entries = {}   # key -> (when, seq, fn)
+        self._seq = itertools.count()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, key, delay, fn):
+        when = time.time() + delay
+        with self._cond:
+            seq = next(self._seq)
+            self._entries[key] = (when, seq, fn)
+            heapq.heappush(self._heap, (when, seq, key))
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            return self._entries.pop(key, None) is not None
+
+    def pending(self, key):
+        with self._cond:
+            return key in self._entries
+
+    def _is_live(self, seq, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] == seq
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = []
+                while not due:
+                    now = time.time()
+                    # Collect everything that is overdue in one go, so a
+                    # stall is caught up in bulk rather than one per wakeup
+                    while self._heap and self._heap[0][0] <= now:
+                        when, seq, key = heapq.heappop(self._heap)
+                        if self._is_live(seq, key):
+                            due.append(self._entries.pop(key)[2])
+                    if due:
+                        break
+                    # Drop cancelled/rescheduled entries sitting on top
+                    while self._heap and not self._is_live(*self._heap[0][1:]):
+                        heapq.heappop(self._heap)
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+
+            for fn in due:
+                try:
+                    fn()
+                except Exception:
+                    app.logger.exception("Scheduled task failed")
+
+# =========================
+# Fair Download Executor
+# =========================
+
+class FairExecutor:
+    """Worker pool that serves per-client queues round-robin.
+
+    Jobs are submitted under a key (the client IP). Each free worker takes
+    the next job from the next key in turn, so a client with a burst of
+    jobs only gets every Nth slot while others are waiting. A key can also
+    be capped to a number of running jobs with limit_key().
+
+    Keys submitted with the same group share one turn, which goes to each
+    of them in turn, so a client can't get more slots by using more keys.
+    """
+
+    def __init__(self, workers, limit=None):
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()   # group -> key -> deque of tickets, both in turn order
+        self._group_of = {}     # key -> group, while the key has tickets queued
+        self._workers = workers
+        self._limit = limit or workers  # jobs allowed to run at once
+        self._active = 0
+        self._running = {}      # key -> jobs running, while any are
+        self._key_limits = {}   # key -> max jobs running at once
+
+    def start(self):
+        for _ in range(self._workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def set_limit(self, limit):
+        # Lowering the limit lets running jobs finish; it only holds back
+        # new ones
+        with self._cond:
+            self._limit = limit
+            self._cond.notify_all()
+
+    def limit_key(self, key, limit):
+        # Kept until the key has nothing queued or running
+        with self._cond:
+            self._key_limits[key] = limit
+
+    def active(self):
+        with self._cond:
+            return self._active
+
+    def submit(self, key, fn, *args, group=None):
+        group = key if group is None else group
+        ticket = {"key": key, "group": group, "fn": fn, "args": args, "state": "queued"}
+        with self._cond:
+            self._queues.setdefault(group, OrderedDict()).setdefault(key, deque()).append(ticket)
+            self._group_of[key] = group
+            self._cond.notify()
+        return ticket
+
+    def position(self, ticket):
+        """1-based place in the dispatch order, or None once started.
+
+        Replays _next() on the queue lengths. A key at its limit_key() cap is
+        passed over until, as an estimate, the jobs running now have finished.
+        """
+        with self._cond:
+            queue = self._queue(ticket)
+            if not queue:
+                return None
+            for index, queued in enumerate(queue):
+                if queued is ticket:
+                    break
+            else:
+                return None
+
+            lengths = OrderedDict((group, OrderedDict((k, len(q)) for k, q in keys.items()))
+                                  for group, keys in self._queues.items())
+            running = dict(self._running)
+            ahead = 0
+            while True:
+                turn = self._pick(lengths, running)
+                if turn is None:
+                    running.clear()
+                    continue
+                group, key = turn
+                if key == ticket["key"]:
+                    if not index:
+                        return ahead + 1
+                    index -= 1
+                ahead += 1
+                running[key] = running.get(key, 0) + 1
+                lengths[group][key] -= 1
+                self._rotate(lengths, group, key, lengths[group][key])
+
+    def cancel(self, ticket):
+        """Drop a job that has not started yet. False if it already has."""
+        with self._cond:
+            queue = self._queue(ticket)
+            if not queue:
+                return False
+            for index, queued in enumerate(queue):
+                if queued is ticket:
+                    del queue[index]
+                    if not queue:
+                        self._rotate(self._queues, ticket["group"], ticket["key"], 0,
+                                     keep_turn=True)
+                        del self._group_of[ticket["key"]]
+                        if ticket["key"] not in self._running:
+                            self._key_limits.pop(ticket["key"], None)
+                    return True
+            return False
+
+    def abandon(self, ticket):
+        """Give up on a running job stuck in its worker thread.
+
+        Its slot is freed and a fresh thread takes the stuck one's place;
+        the stuck thread exits whenever the job finally returns. False if
+        the job is not running.
+        """
+        with self._cond:
+            if ticket["state"] != "running":
+                return False
+            ticket["state"] = "abandoned"
+            self._finished(ticket["key"])
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+
+    def queued(self):
+        with self._cond:
+            return sum(len(q) for keys in self._queues.values() for q in keys.values())
+
+    def _queue(self, ticket):
+        # Caller holds self._cond
+        return self._queues.get(ticket["group"], {}).get(ticket["key"])
+
+    def _pick(self, queues, running):
+        # (group, key) of the first key under its own limit, taking groups in
+        # turn and each group's keys in turn, or None if no key is
+        for group, keys in queues.items():
+            for key in keys:
+                limit = self._key_limits.get(key)
+                if limit is None or running.get(key, 0) < limit:
+                    return group, key
+        return None
+
+    @staticmethod
+    def _rotate(queues, group, key, left, keep_turn=False):
+        # Move a key that was served, and its group, to the back of their
+        # turns; either is dropped once it has nothing left
+        keys = queues[group]
+        if left:
+            keys.move_to_end(key)
+        else:
+            del keys[key]
+        if not keys:
+            del queues[group]
+        elif not keep_turn:
+            queues.move_to_end(group)
+
+    def _next(self):
+        # Caller holds self._cond. The first key in turn that is under its
+        # own limit gives up its oldest ticket, or None if no key can.
+        if self._active >= self._limit:
+            return None
+        turn = self._pick(self._queues, self._running)
+        if turn is None:
+            return None
+
+        group, key = turn
+        queue = self._queues[group][key]
+        ticket = queue.popleft()
+        if not queue:
+            del self._group_of[key]
+        self._rotate(self._queues, group, key, len(queue))
+        self._running[key] = self._running.get(key, 0) + 1
+        self._active += 1
+        return ticket
+
+    def _finished(self, key):
+        # Caller holds self._cond
+        self._active -= 1
+        self._running[key] -= 1
+        if not self._running[key]:
+            del self._running[key]
+            if key not in self._group_of:
+                self._key_limits.pop(key, None)
+        self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while (ticket := self._next()) is None:
+                    self._cond.wait()
+                ticket["state"] = "running"
+            try:
+                ticket["fn"](*ticket["args"])
+            except Exception:
+                app.logger.exception("Download job failed")
+            with self._cond:
+                if ticket["state"] == "abandoned":
+                    return   # a replacement thread already took this slot
+                ticket["state"] = "done"
+                self._finished(ticket["key"])
+
+# =========================
+# Bandwidth Shaper
+# =========================
+
+class TokenBucket:
+    """Paces one job's downloads to the rate returned by get_rate().
+
+    The rate is read on every call, so a rebalanced share applies straight
+    away. A falsy rate means unlimited.
+    """
+
+    def __init__(self, get_rate):
+        self._get_rate = get_rate
+        self._lock = threading.Lock()   # fragment threads share the bucket
+        self._tokens = 0.0
+        self._last = time.monotonic()
+
+    def consume(self, amount):
+        with self._lock:
+            rate = self._get_rate()
+            now = time.monotonic()
+            if not rate:
+                self._tokens = 0.0
+                self._last = now
+                return
+            self._tokens = min(rate * BANDWIDTH_BURST_SECONDS,
+                               self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= amount
+            delay = -self._tokens / rate if self._tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+    def progress_hook(self):
+        # yt-dlp hook charging the bytes each file gained since its last report
+        seen = {}
+
+        def hook(d):
+            if d["status"] != "downloading" or d.get("downloaded_bytes") is None:
+                return
+            name = d.get("filename")
+            done = d["downloaded_bytes"]
+            # The first report of a resumed file includes what was already on disk
+            previous = seen.get(name, done)
+            seen[name] = done
+            if done > previous:
+                self.consume(done - previous)
+
+        return hook
+
+
+class BandwidthShaper:
+    """Splits MAX_INGEST_BYTES_PER_SEC evenly between the running jobs.
+
+    Jobs in this process read share() directly; worker processes read the
+    same figure from a shared value, updated whenever the job count changes.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self._lock = threading.Lock()
+        self._active = 0
+        self.shared_share = multiprocessing.get_context("spawn").Value("d", 0.0, lock=False)
+
+    def share(self):
+        active = self._active
+        if not self.total or not active:
+            return None
+        return self.total / active
+
+    def job_started(self):
+        with self._lock:
+            self._active += 1
+            self.shared_share.value = self.share() or 0.0
+
+    def job_finished(self):
+        with self._lock:
+            self._active -= 1
+            self.shared_share.value = self.share() or 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "limit_bytes_per_sec": self.total,
+                "active_jobs": self._active,
+                "per_job_bytes_per_sec": self.share()
+            }
+
+# =========================
+# Rate Limiter
+# =========================
 
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+def sliding_window_hit(state, now, window, limit, count):
+    """Charge count hits to a [window number, hits in it, hits in the one
+    before] state, or none if that would go over limit.
+
+    Returns (allowed, new state). The hits in the last `window` seconds are
+    estimated by weighting the previous window by how much of it still
+    overlaps.
+    """
+    number = int(now // window)
+    if state is None or state[0] < number - 1:
+        state = [number, 0, 0]
+    elif state[0] < number:
+        state = [number, 0, state[1]]
+    else:
+        state = list(state)
+
+    overlap = 1 - (now - number * window) / window
+    allowed = state[2] * overlap + state[1] + count <= limit
+    if allowed:
+        state[1] += count
+    return allowed, state
+
+
+class RateLimiter:
+    """Sliding-window counter per key (see sliding_window_hit), in bounded
+    memory.
+
+    Keys are kept in least-recently-seen order: stale ones are dropped as
+    they reach the front, and beyond max_keys the oldest goes regardless.
+    Keys charged since the last take_dirty() are remembered, so callers can
+    persist the changes in batches rather than on every hit.
+    """
+
+    def __init__(self, limit, window, max_keys):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        # Reentrant so a caller can hold it across items() for a stable view
+        self.lock = threading.RLock()
+        self._keys = OrderedDict()
+        self._dirty = set()
+
+    def hit(self, key, count=1):
+        """Charge count hits to key, or none and return False if over the limit."""
+        now = time.time()
+        with self.lock:
+            allowed, state = sliding_window_hit(self._keys.get(key), now, self.window,
+                                                self.limit, count)
+            self._keys[key] = state
+            self._keys.move_to_end(key)
+            self._prune(state[0])
+            if allowed:
+                self._dirty.add(key)
+        return allowed
+
+    def load(self, key, state):
+        with self.lock:
+            self._keys[key] = list(state)
+            self._prune(int(time.time() // self.window))
+
+    def items(self):
+        with self.lock:
+            return [(key, list(state)) for key, state in self._keys.items()]
+
+    def take_dirty(self):
+        """Return (key, state) for keys charged since the last call, and forget them."""
+        with self.lock:
+            dirty, self._dirty = self._dirty, set()
+            return [(key, list(self._keys[key])) for key in dirty if key in self._keys]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _prune(self, window):
+        # Caller holds self.lock
+        keys = self._keys
+        while keys:
+            state = next(iter(keys.values()))
+            if state[0] >= window - 1 and len(keys) <= self.max_keys:
+                break
+            keys.popitem(last=False)
+
+# =========================
+# Journal
+# =========================
+
+class Journal:
+    """Append-only JSON-lines log of state changes, replayed at startup.
+
+    record() only queues the fields; a writer thread formats everything
+    queued so far, appends it and flushes (and fsyncs) once per batch, so
+    callers holding LOCK never wait for the disk. A line cut short by a
+    crash is skipped on replay. rewrite() swaps in a snapshot so the log
+    stays small. Until open() is called (worker processes never do)
+    records are dropped.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._cond = threading.Condition()   # guards _pending
+        self._pending = []
+        self._file_lock = threading.Lock()   # guards _file, held while writing
+        self._file = None
+
+    def open(self):
+        with self._file_lock:
+            self._file = open(self.path, "a", encoding="utf-8")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def record(self, op, **fields):
+        # Formatted later by the writer, so the fields must not change
+        if self._file is None:
+            return
+        with self._cond:
+            self._pending.append(dict(fields, op=op))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Taken under the file lock, so rewrite() can't come in between
+            with self._file_lock:
+                with self._cond:
+                    batch, self._pending = self._pending, []
+                if not batch:
+                    continue
+                try:
+                    self._file.write("".join(json.dumps(fields) + "\n" for fields in batch))
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                except Exception:
+                    app.logger.exception("Writing the journal failed")
+
+    def replay(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            return
+
+    def rewrite(self, records):
+        # The caller builds records while holding every lock that record()
+        # is called under, so whatever is still queued is in them already
+        temp = self.path + ".tmp"
+        with self._file_lock:
+            with self._cond:
+                self._pending.clear()
+            with open(temp, "w", encoding="utf-8") as f:
+                for fields in records:
+                    f.write(json.dumps(fields) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+            if self._file is not None:
+                self._file.close()
+                self._file = open(self.path, "a", encoding="utf-8")
+
+# =========================
+# State Backends
+# =========================
+
+class MemoryBackend:
+    """State that only this process sees.
+
+    The routes reach tokens and jobs of other worker processes through the
+    backend; here there are none, so those lookups come back empty. Quota is
+    kept by the in-process RateLimiter.
+    """
+
+    shared = False
+    name = "memory"
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def hit(self, ip, count=1):
+        return self.limiter.hit(ip, count)
+
+    def tracked_ips(self):
+        return len(self.limiter)
+
+    def claim(self, key, spec):
+        return True
+
+    def add_token(self, token, ip, key, started, batch):
+        pass
+
+    def set_expiry(self, token, at):
+        pass
+
+    def drop_token(self, token):
+        pass
+
+    def find_token(self, token):
+        return None
+
+    def request_cancel(self, token):
+        return False
+
+    def followers(self, key):
+        return 0
+
+    def pinned_files(self):
+        return set()
+
+    def add_batch(self, entry):
+        pass
+
+    def find_batch(self, batch_id):
+        return None
+
+    def drop_batch(self, batch_id):
+        pass
+
+
+class SQLiteBackend:
+    """Jobs, tokens and quota in a SQLite file shared by every worker
+    process on the host.
+
+    Each process still runs its own downloads. It claims a cache key before
+    downloading it, publishes the job's progress for the other processes
+    (see sync_state) and heartbeats; jobs and tokens of a process whose
+    heartbeat has gone stale can be taken over. Every thread gets its own
+    connection.
+    """
+
+    shared = True
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS workers (owner TEXT PRIMARY KEY, heartbeat REAL);
+        CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, owner TEXT, status TEXT,
+                                         spec TEXT, view TEXT, updated REAL);
+        CREATE TABLE IF NOT EXISTS tokens (token TEXT PRIMARY KEY, owner TEXT, ip TEXT,
+                                           key TEXT, started REAL, batch TEXT,
+                                           expires REAL, cancel INTEGER DEFAULT 0);
+        CREATE INDEX IF NOT EXISTS tokens_key ON tokens (key);
+        CREATE TABLE IF NOT EXISTS quota (ip TEXT PRIMARY KEY, period INTEGER, hits INTEGER,
+                                          previous INTEGER, seen REAL);
+        CREATE TABLE IF NOT EXISTS batches (id TEXT PRIMARY KEY, ip TEXT, tokens TEXT,
+                                            created REAL);
+    """
+    UNFINISHED = "status NOT IN ('done', 'error', 'cancelled')"
+
+    def __init__(self, path, limit, window, max_keys, stale_seconds):
+        self.path = path
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.stale_seconds = stale_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(self.SCHEMA)
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def hit(self, ip, count=1):
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT period, hits, previous FROM quota WHERE ip = ?",
+                             (ip,)).fetchone()
+            allowed, state = sliding_window_hit(row, now, self.window, self.limit, count)
+            db.execute("INSERT OR REPLACE INTO quota VALUES (?, ?, ?, ?, ?)", (ip, *state, now))
+        return allowed
+
+    def tracked_ips(self):
+        return self._db().execute("SELECT COUNT(*) FROM quota").fetchone()[0]
+
+    def claim(self, key, spec):
+        """Take the download of key, unless a live process already has it."""
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (self.owner, now))
+            row = db.execute("SELECT j.owner, j.status, w.heartbeat FROM jobs j "
+                             "LEFT JOIN workers w ON w.owner = j.owner WHERE j.key = ?",
+                             (key,)).fetchone()
+            if (row and row[0] != self.owner and row[1] not in FINISHED
+                    and (row[2] or 0) >= now - self.stale_seconds):
+                return False
+            db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, 'queued', ?, NULL, ?)",
+                       (key, self.owner, json.dumps(spec), now))
+        return True
+
+    def publish(self, views):
+        """Heartbeat, and store the latest view of jobs this process owns.
+
+        Returns the keys whose job another process has taken over meanwhile;
+        their views are not stored.
+        """
+        now = time.time()
+        lost = []
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (self.owner, now))
+            for key, view in views.items():
+                updated = db.execute("UPDATE jobs SET status = ?, view = ?, updated = ? "
+                                     "WHERE key = ? AND owner = ?",
+                                     (view["status"], json.dumps(view), now, key,
+                                      self.owner)).rowcount
+                if not updated:
+                    lost.append(key)
+        return lost
+
+    def job(self, key):
+        row = self._db().execute("SELECT j.view, j.status, w.heartbeat FROM jobs j "
+                                 "LEFT JOIN workers w ON w.owner = j.owner WHERE j.key = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "view": json.loads(row[0]) if row[0] else None,
+            "status": row[1],
+            "live": (row[2] or 0) >= time.time() - self.stale_seconds
+        }
+
+    def orphans(self):
+        """(key, spec) of unfinished jobs whose process has gone quiet."""
+        rows = self._db().execute(
+            "SELECT j.key, j.spec FROM jobs j LEFT JOIN workers w ON w.owner = j.owner "
+            f"WHERE j.{self.UNFINISHED} AND (w.heartbeat IS NULL OR w.heartbeat < ?)",
+            (time.time() - self.stale_seconds,)).fetchall()
+        return [(key, json.loads(spec)) for key, spec in rows]
+
+    def unfinished_keys(self):
+        return [row[0] for row in self._db().execute(
+            f"SELECT key FROM jobs WHERE {self.UNFINISHED}")]
+
+    def add_token(self, token, ip, key, started, batch):
+        self._db().execute("INSERT OR REPLACE INTO tokens (token, owner, ip, key, started, batch) "
+                           "VALUES (?, ?, ?, ?, ?, ?)",
+                           (token, self.owner, ip, key, started, batch))
+
+    def set_expiry(self, token, at):
+        self._db().execute("UPDATE tokens SET expires = ? WHERE token = ?", (at, token))
+
+    def drop_token(self, token):
+        self._db().execute("DELETE FROM tokens WHERE token = ?", (token,))
+
+    def find_token(self, token):
+        row = self._db().execute(
+            "SELECT t.ip, t.key, t.started, t.batch, j.view FROM tokens t "
+            "LEFT JOIN jobs j ON j.key = t.key "
+            "WHERE t.token = ? AND (t.expires IS NULL OR t.expires > ?)",
+            (token, time.time())).fetchone()
+        if row is None:
+            return None
+        return {
+            "token": token,
+            "ip": row[0],
+            "key": row[1],
+            "started": row[2],
+            "batch": row[3],
+            "view": json.loads(row[4]) if row[4] else None
+        }
+
+    def adopt_tokens(self, key):
+        """Move the live tokens of key held by quiet processes to this one."""
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+                "SELECT t.token, t.ip, t.started, t.batch, t.expires FROM tokens t "
+                "LEFT JOIN workers w ON w.owner = t.owner WHERE t.key = ? "
+                "AND (w.heartbeat IS NULL OR w.heartbeat < ?) "
+                "AND (t.expires IS NULL OR t.expires > ?)",
+                (key, now - self.stale_seconds, now)).fetchall()
+            for row in rows:
+                db.execute("UPDATE tokens SET owner = ? WHERE token = ?", (self.owner, row[0]))
+        return [dict(zip(("token", "ip", "started", "batch", "expires"), row)) for row in rows]
+
+    def request_cancel(self, token):
+        # The owning process picks this up in take_cancels()
+        return self._db().execute("UPDATE tokens SET cancel = 1 WHERE token = ?",
+                                  (token,)).rowcount > 0
+
+    def take_cancels(self):
+        with self._transaction() as db:
+            rows = db.execute("SELECT token FROM tokens WHERE owner = ? AND cancel = 1",
+                              (self.owner,)).fetchall()
+            db.execute("UPDATE tokens SET cancel = 0 WHERE owner = ? AND cancel = 1",
+                       (self.owner,))
+        return [row[0] for row in rows]
+
+    def followers(self, key):
+        """Live tokens of other processes waiting for key."""
+        return self._db().execute(
+            "SELECT COUNT(*) FROM tokens WHERE key = ? AND owner != ? "
+            "AND (expires IS NULL OR expires > ?)",
+            (key, self.owner, time.time())).fetchone()[0]
+
+    def pinned_files(self):
+        """Cache keys any process still has a live token for."""
+        return {row[0] for row in self._db().execute(
+            "SELECT DISTINCT key FROM tokens WHERE expires IS NULL OR expires > ?",
+            (time.time(),))}
+
+    def add_batch(self, entry):
+        self._db().execute("INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?)",
+                           (entry["id"], entry["ip"], json.dumps(entry["tokens"]),
+                            entry["created"]))
+
+    def find_batch(self, batch_id):
+        row = self._db().execute("SELECT ip, tokens, created FROM batches WHERE id = ?",
+                                 (batch_id,)).fetchone()
+        if row is None:
+            return None
+        return {"id": batch_id, "ip": row[0], "tokens": json.loads(row[1]), "created": row[2]}
+
+    def drop_batch(self, batch_id):
+        self._db().execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+
+    def prune(self):
+        # Expired tokens, stale quota and anything nobody refers to any more
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("DELETE FROM tokens WHERE expires <= ?", (now,))
+            db.execute("DELETE FROM quota WHERE period < ?", (int(now // self.window) - 1,))
+            db.execute("DELETE FROM quota WHERE ip IN "
+                       "(SELECT ip FROM quota ORDER BY seen DESC LIMIT -1 OFFSET ?)",
+                       (self.max_keys,))
+            db.execute("DELETE FROM batches WHERE NOT EXISTS "
+                       "(SELECT 1 FROM tokens WHERE tokens.batch = batches.id)")
+            db.execute(f"DELETE FROM jobs WHERE NOT {self.UNFINISHED} AND updated < ? "
+                       "AND NOT EXISTS (SELECT 1 FROM tokens WHERE tokens.key = jobs.key)",
+                       (now - self.stale_seconds,))
+            db.execute("DELETE FROM workers WHERE heartbeat < ?", (now - self.stale_seconds,))
 
 # =========================
 # Global State
 # =========================
 
 app = Flask(__name__)
-executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS)
+app.config["USE_X_SENDFILE"] = DELIVERY_MODE != "direct"
+executor = FairExecutor(PARALLEL_DOWNLOADS_RANGE[1], MAX_PARALLEL_DOWNLOADS)
+merge_executor = ThreadPoolExecutor(max_workers=MERGE_WORKERS)
+SCHEDULER = Scheduler()
+SHAPER = BandwidthShaper(MAX_INGEST_BYTES_PER_SEC)
+JOURNAL = Journal(JOURNAL_PATH, JOURNAL_FSYNC)
+LIMITER = RateLimiter(MAX_DOWNLOADS_PER_DAY, QUOTA_WINDOW_SECONDS, RATE_LIMIT_MAX_KEYS)
+if STATE_BACKEND == "sqlite":
+    STATE = SQLiteBackend(STATE_DB_PATH, MAX_DOWNLOADS_PER_DAY, QUOTA_WINDOW_SECONDS,
+                          RATE_LIMIT_MAX_KEYS, STATE_STALE_SECONDS)
+else:
+    STATE = MemoryBackend(LIMITER)
 
 DOWNLOADS = {}   # token -> info
-IP_LIMITS = {}   # ip -> {date, count}
+BATCHES = {}     # batch id -> {id, ip, tokens, created}
+JOBS = {}        # cached file path -> running job, shared by its tokens
+FOLLOWED = {}    # cached file path -> local mirror of a job another process runs
+STOPPING = set() # cancelled jobs still running whose key a fresh job has taken
+DIRTY = {}       # cached file path -> local job whose changes aren't shared yet
+ABANDONED = {}   # cached file path -> attempts given up on whose worker may still write
+CACHE = {}       # cached file path -> {size, refs, transfers, hits, last_used}
+JOB_DURATIONS = deque(maxlen=50)  # seconds spent in the download stage, recent jobs
+CONCURRENCY = {  # adaptive controller state
+    "downloads": MAX_PARALLEL_DOWNLOADS,
+    "fragments": FRAGMENT_THREADS,
+    "throughput": None,   # bytes/sec at the last adjustment
+    "last_action": None
+}
+# Guards the registries above. Each job has its own lock for its fields,
+# taken after LOCK when both are needed (see mark_changed).
 LOCK = threading.Lock()
 
 # =========================
 # Helpers
 # =========================
 
-def today():
-    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+def check_ip_limit(ip, count=1):
+    # Charges count downloads at once, or nothing if they don't all fit
+    return STATE.hit(ip, count)
 
 
-def check_ip_limit(ip):
+def drop_token(token, reason):
+    # Forget a token; its job is cancelled with reason if no token, here or
+    # in another worker process, wants it any more. False if already gone.
     with LOCK:
-        entry = IP_LIMITS.get(ip)
-        if not entry or entry["date"] != today():
-            IP_LIMITS[ip] = {"date": today(), "count": 1}
-            return True
-        if entry["count"] >= MAX_DOWNLOADS_PER_DAY:
+        info = DOWNLOADS.pop(token, None)
+        if not info:
             return False
-        entry["count"] += 1
+        JOURNAL.record("drop", token=token)
+        SCHEDULER.cancel(("token", token))
+        job = info["job"]
+        job.tokens.discard(token)
+        if job.file:
+            release_file(job.file)
+        orphaned = not job.tokens and not job.remote
+        with job.changed:
+            job.changed.notify_all()
+
+    # The backend is only asked outside LOCK, then the job checked again
+    STATE.drop_token(token)
+    if orphaned and not STATE.followers(job.key):
+        with LOCK:
+            if not job.tokens:
+                cancel_job(job, reason)
+    return True
+
+
+def expire_token(token):
+    # Also ends a queued or running download nobody polls any more
+    drop_token(token, "Expired")
+
+
+def token_lifetime(status):
+    # Seconds a token stays valid once its job finished with this status.
+    # Every outcome expires, so failures don't pile up in DOWNLOADS.
+    if status == "done":
+        return TOKEN_EXPIRE_SECONDS
+    if status == "cancelled":
+        return CANCELLED_TOKEN_EXPIRE_SECONDS
+    return FAILED_TOKEN_EXPIRE_SECONDS
+
+
+def schedule_token_expire(token, delay, pending=False):
+    # The deadline is journaled so a restart keeps it. A pending one (see
+    # touch_token) never replaces the lifetime a finished job set.
+    at = time.time() + delay
+    with LOCK:
+        info = DOWNLOADS.get(token)
+        if not info or (pending and info["job"].status in FINISHED):
+            return
+        info["expires"] = at
+        JOURNAL.record("expire", token=token, at=at)
+        # Under LOCK, so the last deadline set is the one that runs
+        SCHEDULER.schedule(("token", token), delay, functools.partial(expire_token, token))
+    STATE.set_expiry(token, at)
+
+
+def touch_token(token):
+    # Called whenever a token is used. Until its download finishes it lives
+    # PENDING_TOKEN_EXPIRE_SECONDS past its last use, so a queued job the
+    # client gave up on doesn't wait for a slot forever. The deadline is
+    # only moved once half of it is gone, to keep polling cheap.
+    info = DOWNLOADS.get(token)
+    if (info and info["job"].status not in FINISHED
+            and info.get("expires", 0) - time.time() < PENDING_TOKEN_EXPIRE_SECONDS / 2):
+        schedule_token_expire(token, PENDING_TOKEN_EXPIRE_SECONDS, pending=True)
+
+
+def expire_batch(batch_id):
+    # A batch lives as long as any of its tokens does
+    with LOCK:
+        entry = BATCHES.get(batch_id)
+        if not entry:
+            return
+        dropped = not any(token in DOWNLOADS for token in entry["tokens"])
+        if dropped:
+            del BATCHES[batch_id]
+            JOURNAL.record("drop_batch", id=batch_id)
+    if dropped:
+        STATE.drop_batch(batch_id)
+    else:
+        schedule_batch_expire(batch_id)
+
+
+def schedule_batch_expire(batch_id):
+    SCHEDULER.schedule(("batch", batch_id), TOKEN_EXPIRE_SECONDS,
+                       functools.partial(expire_batch, batch_id))
+
+
+def job_view(job):
+    # Caller must hold the job's lock. The job's half of a progress payload,
+    # which is also what other worker processes get to see of it.
+    return {
+        "status": job.status,
+        "percent": job.percent,
+        "speed_bps": job.speed,
+        "eta_seconds": job.eta,
+        "downloaded_bytes": job.downloaded_bytes,
+        "total_bytes": job.total_bytes,
+        "format": job.format,
+        "ready": job.status == "done",
+        "error": job.error,
+        "queue_position": (executor.position(job.ticket) if job.ticket
+                           else job.queue_position),
+        "version": job.version,
+        "file": job.file
+    }
+
+
+def current_view(job):
+    # The job's latest snapshot; safe to read without any lock. Its queue
+    # position moves as other jobs start without the job changing, so that
+    # is looked up now.
+    view = job.view
+    if view["status"] == "queued" and job.ticket:
+        view = dict(view, queue_position=executor.position(job.ticket))
+    return view
+
+
+def progress_payload(info, view=None):
+    # view is given for another process's job
+    view = dict(view or current_view(info["job"]))
+    del view["file"]   # a server path, not for clients
+    return dict(view, token=info["token"], elapsed=round(time.time() - info["started"], 2))
+
+
+def shared_info(token):
+    # A token held by another worker process, as {token, ip, started, batch,
+    # key, view}, or None. The file can be in the cache before its owner has
+    # published that it is done.
+    info = STATE.find_token(token)
+    if info is None:
+        return None
+    view = info["view"] or {
+        "status": "queued",
+        "percent": 0,
+        "speed_bps": None,
+        "eta_seconds": None,
+        "downloaded_bytes": 0,
+        "total_bytes": None,
+        "format": os.path.splitext(info["key"])[1][1:],
+        "ready": False,
+        "error": None,
+        "queue_position": None,
+        "version": 0,
+        "file": None
+    }
+    if view["status"] != "done" and os.path.exists(info["key"]):
+        size = os.path.getsize(info["key"])
+        view = dict(view, status="done", ready=True, percent=100.0, downloaded_bytes=size,
+                    total_bytes=size, file=info["key"], queue_position=None)
+    info["view"] = view
+    return info
+
+
+def send_media(path, download_name):
+    # Published files never change, so cache key + size + mtime is a strong
+    # validator. send_file answers HEAD, Range and If-Range (206/416) and
+    # conditional GETs (304) from these, which lets clients resume. Like
+    # DOWNLOAD_DIR, path is relative to the working directory, not to the
+    # app's root_path that send_file would resolve it against.
+    filename = os.path.abspath(path)
+    if DELIVERY_MODE != "direct":
+        # The proxy sends the bytes (and handles Range itself), so the
+        # worker thread is free as soon as the headers are out
+        response = send_file(filename, as_attachment=True, download_name=download_name,
+                             conditional=False, etag=False)
+        if DELIVERY_MODE == "x-accel-redirect":
+            del response.headers["X-Sendfile"]
+            response.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX + os.path.basename(path)
+        return response
+
+    stat = os.stat(path)
+    key = os.path.splitext(os.path.basename(path))[0]
+    response = send_file(filename, as_attachment=True, download_name=download_name,
+                         conditional=True,
+                         etag=f"{key}-{stat.st_size}-{int(stat.st_mtime)}",
+                         last_modified=stat.st_mtime)
+
+    # Keep the eviction manager off the file until the body is sent. The
+    # body itself carries the callback: send_file's response is passed
+    # through as is, so call_on_close would never run. HEAD and 304 close
+    # it through response.close() instead.
+    begin_transfer(path)
+    response.response = ClosingIterator(response.response,
+                                        functools.partial(end_transfer, path))
+    return response
+
+
+def estimated_wait():
+    # Caller must hold LOCK. Seconds until a job queued now would start.
+    average = sum(JOB_DURATIONS) / len(JOB_DURATIONS) if JOB_DURATIONS else DEFAULT_JOB_SECONDS
+    return executor.queued() * average / max(executor.limit, 1), average
+
+
+def admission_retry_after():
+    # Caller must hold LOCK. None if a new job may be queued, otherwise the
+    # number of seconds after which it probably could be.
+    queued = executor.queued()
+    wait, average = estimated_wait()
+    retry = 0
+    if queued >= MAX_QUEUE_DEPTH:
+        retry = (queued - MAX_QUEUE_DEPTH + 1) * average / max(executor.limit, 1)
+    if wait > MAX_ESTIMATED_WAIT_SECONDS:
+        retry = max(retry, wait - MAX_ESTIMATED_WAIT_SECONDS)
+    if queued < MAX_QUEUE_DEPTH and wait <= MAX_ESTIMATED_WAIT_SECONDS:
+        return None
+    return max(1, math.ceil(retry))
+
+
+def build_format(res, audio, fmt):
+    video_ext = "mp4" if fmt == "mp4" else "webm"
+    audio_ext = "m4a" if fmt == "mp4" else "webm"
+
+    video = f"bestvideo[ext={video_ext}]"
+    if res:
+        video += f"[height<={res}]"
+
+    audio_part = f"bestaudio[ext={audio_ext}][abr<={audio}]"
+    return f"{video}+{audio_part}/best"
+
+
+def build_stream_format(res, fmt):
+    # A single progressive file over plain HTTP: no merge step, and it is
+    # written front to back, so it can be sent while it grows
+    single = f"best[ext={fmt}][vcodec!=none][acodec!=none][protocol^=http]"
+    if res:
+        return f"{single}[height<={res}]/{single}"
+    return single
+
+
+def cache_path(video_id, format_string, fmt):
+    # Same video + same resolved format -> same file, whoever asked for it
+    key = hashlib.sha1(f"{video_id}\n{format_string}".encode()).hexdigest()
+    return os.path.join(DOWNLOAD_DIR, f"{key}.{fmt}")
+
+
+FINISHED = ("done", "error", "cancelled")   # job states that never change again
+
+
+class Job:
+    """One download, shared by every token that asked for the same file."""
+
+    __slots__ = ("key", "video_id", "format", "format_string", "stream", "attempt", "partial",
+                 "status", "percent", "speed", "eta", "downloaded_bytes", "total_bytes",
+                 "file", "error", "tokens", "ticket", "cancelled", "fetch_started",
+                 "progress_at", "remote", "queue_position", "remote_version", "version",
+                 "view", "changed")
+
+    def __init__(self, key, video_id, fmt, format_string, stream=False):
+        self.key = key
+        self.video_id = video_id
+        self.format = fmt
+        self.format_string = format_string
+        self.stream = stream
+        # Where the file grows while downloading, before it is published. An
+        # attempt the watchdog gave up on may still be writing its own, so
+        # this one gets another name until that worker has returned.
+        busy = ABANDONED.get(key, ())
+        self.attempt = next(n for n in itertools.count() if n not in busy)
+        self.partial = (os.path.splitext(key)[0] + ".download"
+                        + (str(self.attempt) if self.attempt else "") + f".{fmt}")
+        self.status = "queued"
+        self.percent = 0
+        self.speed = None
+        self.eta = None
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.file = None
+        self.error = None
+        self.tokens = set()
+        self.ticket = None          # place in the executor queue while queued
+        self.cancelled = None       # reason, once the job has been asked to stop
+        self.fetch_started = None   # when the network stage began, while it runs
+        self.progress_at = None     # last time the download moved forward
+        self.remote = False         # mirrors a job another worker process runs
+        self.queue_position = None  # as last reported by that process
+        self.remote_version = None  # version of that process's last report
+        self.version = 0            # bumped on every state change
+        # The job's lock (reentrant), also notified on every change
+        self.changed = threading.Condition()
+        # Immutable snapshot for readers, replaced on every change
+        self.view = job_view(self)
+
+
+def mark_changed(job):
+    # Publishes a new snapshot of the job and wakes whoever waits on it.
+    # Progress hooks write the job's fields under its lock alone, so other
+    # writers of those fields take that lock too; the rest only need LOCK.
+    with job.changed:
+        job.version += 1
+        job.view = job_view(job)
+        job.changed.notify_all()
+    if STATE.shared and not job.remote:
+        DIRTY[job.key] = job
+
+
+class JobCancelled(yt_dlp.utils.DownloadCancelled):
+    """Raised from the progress hook to stop a running yt-dlp download."""
+
+
+def live_job(path):
+    # Caller must hold LOCK. The job a new token for path can join: one this
+    # process runs, unless it is being cancelled, or one another runs.
+    job = JOBS.get(path)
+    if job is not None and not job.cancelled:
+        return job
+    return FOLLOWED.get(path)
+
+
+def forget_job(job):
+    # Caller must hold LOCK. A fresh job may already have taken the key of
+    # one that was being cancelled.
+    if JOBS.get(job.key) is job:
+        del JOBS[job.key]
+    STOPPING.discard(job)
+
+
+def discard_partials(job):
+    # For a job that never gets to run: the files a previous run left
+    # behind (see restore_state) go, then its partial name is free again
+    remove_partials(job)
+    with LOCK:
+        release_attempt(job)
+
+
+def cancel_job(job, reason):
+    # Caller must hold LOCK. A queued job is dropped at once; a running one
+    # stops at its next progress callback, or before the merge. Either way
+    # a new token for the same file gets a fresh job (see live_job), which
+    # writes under another partial name until the old files are gone.
+    if job.cancelled or job.status in FINISHED:
+        return
+    job.cancelled = reason
+    ABANDONED.setdefault(job.key, set()).add(job.attempt)
+    if job.ticket and executor.cancel(job.ticket):
+        forget_job(job)
+        job.status = "cancelled"
+        job.error = reason
+        # Off the lock, like the running job's worker does in fail_job
+        SCHEDULER.schedule(("partials", job.key, job.attempt), 0,
+                           functools.partial(discard_partials, job))
+    mark_changed(job)
+
+
+def cancel_token(token):
+    return drop_token(token, "Cancelled")
+
+
+def cached_job(path, video_id, fmt, format_string):
+    # Caller must hold LOCK. A finished job for a file already in the cache.
+    size = os.path.getsize(path)
+    acquire_file(path)
+    job = Job(path, video_id, fmt, format_string)
+    job.status = "done"
+    job.percent = 100.0
+    job.downloaded_bytes = job.total_bytes = size
+    job.file = path
+    mark_changed(job)
+    return job
+
+
+def queue_job(job, ip, batch_id=None):
+    # Caller must hold LOCK. A batch queues on its own but within its
+    # client's turn in the round-robin, capped at BATCH_MAX_ACTIVE running
+    # downloads so it can't take every slot. The cap is only set along with
+    # a job, as the executor drops it once the key has nothing queued or
+    # running.
+    queue_key = ip
+    if batch_id:
+        queue_key = (ip, batch_id)
+        executor.limit_key(queue_key, BATCH_MAX_ACTIVE)
+    job.ticket = executor.submit(queue_key, download_worker, job, group=ip)
+
+
+def needs_claim(path):
+    # Caller must hold LOCK. Neither a cached file nor a job to follow here
+    return not os.path.exists(path) and live_job(path) is None
+
+
+def attach_token(token, ip, video_id, fmt, format_string, claims, stream=False,
+                 batch_id=None):
+    # Caller must hold LOCK. Points a new token at the cached file, the
+    # running job for it, or a freshly queued job, which claims (path ->
+    # result of STATE.claim) says whether to run here. Returns (job, cached).
+    cached_path = cache_path(video_id, format_string, fmt)
+    cached = os.path.exists(cached_path)
+    if cached:
+        # Cache hit: same video and format already on disk
+        job = cached_job(cached_path, video_id, fmt, format_string)
+    else:
+        # Follow a running job for the same file instead of starting another
+        job = live_job(cached_path)
+        if job is None:
+            if cached_path in JOBS:
+                # Cancelled but still running; the watchdog keeps an eye on it
+                STOPPING.add(JOBS[cached_path])
+            if claims[cached_path]:
+                job = JOBS[cached_path] = Job(cached_path, video_id, fmt, format_string,
+                                              stream)
+                queue_job(job, ip, batch_id)
+            else:
+                # Another worker process is downloading it; sync_state keeps
+                # this copy up to date
+                job = FOLLOWED[cached_path] = Job(cached_path, video_id, fmt,
+                                                  format_string, stream)
+                job.remote = True
+
+    job.tokens.add(token)
+    DOWNLOADS[token] = {
+        "token": token,
+        "ip": ip,
+        "started": time.time(),
+        "batch": batch_id,
+        "job": job
+    }
+    JOURNAL.record("token", **token_record(DOWNLOADS[token]))
+    return job, cached
+
+
+def attach_tokens(ip, items, batch_id=None):
+    """Attach each (token, video_id, fmt, format_string, stream) item.
+
+    The backend is asked outside LOCK: claims are taken for the downloads
+    nothing here covers, then checked again under LOCK, until none is
+    missing. Returns the (job, cached) of each item, or None if a token is
+    already in use.
+    """
+    claims = {}
+    while True:
+        with LOCK:
+            if any(item[0] in DOWNLOADS for item in items):
+                return None
+            unclaimed = {}
+            for token, video_id, fmt, format_string, stream in items:
+                path = cache_path(video_id, format_string, fmt)
+                if path not in claims and needs_claim(path):
+                    unclaimed[path] = {"video_id": video_id, "format": fmt,
+                                       "format_string": format_string, "stream": stream}
+            if not unclaimed:
+                attached = [attach_token(token, ip, video_id, fmt, format_string, claims,
+                                         stream, batch_id)
+                            for token, video_id, fmt, format_string, stream in items]
+                break
+        for path, spec in unclaimed.items():
+            claims[path] = STATE.claim(path, spec)
+
+    for token, (job, _) in zip((item[0] for item in items), attached):
+        info = DOWNLOADS.get(token)
+        if info is None:
+            continue
+        STATE.add_token(token, ip, job.key, info["started"], batch_id)
+        if token not in DOWNLOADS:
+            STATE.drop_token(token)   # dropped meanwhile
+    return attached
+
+
+def token_record(info):
+    # Journal form of a DOWNLOADS entry; enough to rebuild it and its job
+    job = info["job"]
+    return {
+        "token": info["token"],
+        "ip": info["ip"],
+        "started": info["started"],
+        "batch": info["batch"],
+        "key": job.key,
+        "video_id": job.video_id,
+        "format": job.format,
+        "format_string": job.format_string,
+        "stream": job.stream
+    }
+
+
+def client_disconnected():
+    # Peek at the request's socket: readable with no data means the client
+    # hung up. Only works on servers that expose the socket in the environ.
+    sock = request.environ.get("werkzeug.socket") or request.environ.get("gunicorn.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        # e.g. TLS sockets, which can't peek
+        return False
+    except OSError:
         return True
 
 
-def schedule_delete(path, delay):
-    def worker():
-        time.sleep(delay)
-        try:
-            if os.path.exists(path):
-                os.remove(path)
-        except:
-            pass
-    threading.Thread(target=worker, daemon=True).start()
+def wait_for_job(job, token, ready):
+    # Holds a not-json request until ready(view) holds for the job's view
+    # and returns that view, or None if the client hung up meanwhile. Aborts
+    # if the job fails, the token goes away or the wait runs out.
+    deadline = time.time() + NOT_JSON_MAX_WAIT_SECONDS
+    while True:
+        next_check = time.time() + DISCONNECT_CHECK_SECONDS
+        with job.changed:
+            while time.time() < next_check:
+                if token not in DOWNLOADS:
+                    abort(410)
+                view = job.view
+                if ready(view):
+                    return view
+                if view["status"] == "error":
+                    abort(500)
+                if view["status"] == "cancelled":
+                    abort(410)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    abort(504)
+                # Releases the job's lock while waiting, woken by mark_changed
+                job.changed.wait(min(remaining, next_check - time.time()))
+
+        # Outside the job's lock, which touch_token must not be taken under
+        if client_disconnected():
+            return None
+        touch_token(token)
+
+
+# =========================
+# Media Cache
+# =========================
+
+CACHE_FILE_RE = re.compile(r"^[0-9a-f]{40}\.(mp4|webm)$")
+
+
+def cache_entry(path):
+    # Caller must hold LOCK
+    entry = CACHE.get(path)
+    if entry is None:
+        entry = CACHE[path] = {
+            "size": os.path.getsize(path),
+            "refs": 0,        # tokens pointing at the file
+            "transfers": 0,   # responses currently reading it
+            "hits": 0,
+            "last_used": time.time()
+        }
+    return entry
+
+
+def acquire_file(path):
+    # Caller must hold LOCK
+    entry = cache_entry(path)
+    entry["refs"] += 1
+    entry["hits"] += 1
+    entry["last_used"] = time.time()
+
+
+def release_file(path):
+    # Caller must hold LOCK
+    entry = CACHE.get(path)
+    if entry is None:
+        return
+    entry["refs"] -= 1
+    entry["last_used"] = time.time()
+
+
+def begin_transfer(path):
+    with LOCK:
+        entry = cache_entry(path)
+        entry["transfers"] += 1
+        entry["last_used"] = time.time()
+
+
+def end_transfer(path):
+    with LOCK:
+        entry = CACHE.get(path)
+        if entry:
+            entry["transfers"] -= 1
+
+
+def cache_budget(used):
+    # Files we already hold count as room we could free
+    free = shutil.disk_usage(DOWNLOAD_DIR).free
+    return max(0, min(CACHE_MAX_BYTES, used + free - CACHE_MIN_FREE_BYTES))
+
+
+def remove_cached(path):
+    # Caller must hold LOCK
+    CACHE.pop(path, None)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def evict_cache(pinned):
+    # Caller must hold LOCK. pinned holds the files other processes' tokens
+    # point at, which the caller got from STATE before taking LOCK.
+    now = time.time()
+    idle = [p for p, e in CACHE.items()
+            if e["refs"] == 0 and e["transfers"] == 0 and p not in pinned]
+
+    if CACHE_MAX_IDLE_SECONDS is not None:
+        for path in idle:
+            if now - CACHE[path]["last_used"] > CACHE_MAX_IDLE_SECONDS:
+                remove_cached(path)
+        idle = [p for p in idle if p in CACHE]
+
+    used = sum(e["size"] for e in CACHE.values())
+    budget = cache_budget(used)
+    if used <= budget * CACHE_HIGH_WATERMARK:
+        return
+
+    if CACHE_EVICTION_POLICY == "lfu":
+        idle.sort(key=lambda p: (CACHE[p]["hits"], CACHE[p]["last_used"]))
+    else:
+        idle.sort(key=lambda p: CACHE[p]["last_used"])
+
+    target = budget * CACHE_LOW_WATERMARK
+    for path in idle:
+        if used <= target:
+            break
+        used -= CACHE[path]["size"]
+        remove_cached(path)
+
+
+def sweep_cache():
+    try:
+        pinned = STATE.pinned_files()
+        with LOCK:
+            if STATE.shared:
+                index_cache()   # pick up files other processes published or evicted
+            evict_cache(pinned)
+    finally:
+        SCHEDULER.schedule(("cache", "sweep"), CACHE_SWEEP_SECONDS, sweep_cache)
+
+
+def cache_stats():
+    # Caller must hold LOCK
+    used = sum(e["size"] for e in CACHE.values())
+    budget = cache_budget(used)
+    return {
+        "files": len(CACHE),
+        "used_bytes": used,
+        "budget_bytes": budget,
+        "high_watermark_bytes": int(budget * CACHE_HIGH_WATERMARK),
+        "low_watermark_bytes": int(budget * CACHE_LOW_WATERMARK),
+        "disk_free_bytes": shutil.disk_usage(DOWNLOAD_DIR).free,
+        "pinned_files": sum(1 for e in CACHE.values() if e["refs"] or e["transfers"]),
+        "policy": CACHE_EVICTION_POLICY
+    }
+
+
+def index_cache():
+    # Caller must hold LOCK. Track every cached file on disk, and forget
+    # files that are gone.
+    found = set()
+    for name in os.listdir(DOWNLOAD_DIR):
+        if CACHE_FILE_RE.match(name):
+            path = os.path.join(DOWNLOAD_DIR, name)
+            if path not in CACHE:
+                try:
+                    mtime = os.path.getmtime(path)
+                    cache_entry(path)["last_used"] = mtime
+                except FileNotFoundError:
+                    continue   # removed (e.g. by another process) since listdir
+            found.add(path)
+    for path in [p for p in CACHE if p not in found]:
+        del CACHE[path]
+
+
+def load_cache():
+    # Pick up files left by a previous run so they count and can be evicted
+    with LOCK:
+        index_cache()
+    sweep_cache()
+
+
+# =========================
+# Adaptive Concurrency
+# =========================
+
+def adjust_concurrency():
+    try:
+        with LOCK:
+            total = sum(j.speed or 0 for j in JOBS.values() if j.status == "downloading")
+            previous = CONCURRENCY["throughput"]
+            downloads = CONCURRENCY["downloads"]
+            fragments = CONCURRENCY["fragments"]
+            queued = executor.queued()
+            # With free slots and nothing queued, a lower total only means less
+            # demand, not a congested link
+            saturated = executor.active() >= downloads
+
+            if total <= 0:
+                action = "idle"
+            elif previous and saturated and total < previous * (1 - CONCURRENCY_BACKOFF):
+                downloads = max(PARALLEL_DOWNLOADS_RANGE[0], int(downloads * CONCURRENCY_DECREASE))
+                fragments = max(FRAGMENT_THREADS_RANGE[0], int(fragments * CONCURRENCY_DECREASE))
+                action = "decrease"
+            elif not previous or total >= previous * (1 + CONCURRENCY_GAIN):
+                # Add a job slot when there is work waiting for one, otherwise
+                # try more fragment threads for the jobs already running
+                if queued and downloads < PARALLEL_DOWNLOADS_RANGE[1]:
+                    downloads += 1
+                else:
+                    fragments = min(FRAGMENT_THREADS_RANGE[1], fragments + 1)
+                action = "increase"
+            else:
+                action = "hold"
+
+            if total > 0:
+                CONCURRENCY["throughput"] = total
+            CONCURRENCY.update({
+                "downloads": downloads,
+                "fragments": fragments,
+                "last_action": action
+            })
+
+        executor.set_limit(downloads)
+    finally:
+        SCHEDULER.schedule(("concurrency", "adjust"), CONCURRENCY_ADJUST_SECONDS,
+                           adjust_concurrency)
+
+
+# =========================
+# Download Worker
+# =========================
+
+def stream_growing_file(job, token):
+    # Yields the job's output as it is written, then whatever is left once
+    # it is published. A failed download just ends the (chunked) response.
+    f = None
+    try:
+        while True:
+            touch_token(token)   # the client is still reading
+            if f is None:
+                with job.changed:
+                    view = job.view
+                    if view["status"] in ("error", "cancelled"):
+                        return
+                    path = view["file"] if view["status"] == "done" else job.partial
+                    if not os.path.exists(path):
+                        job.changed.wait(STREAM_POLL_SECONDS)
+                        continue
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    # Published between the check and the open, try again
+                    continue
+
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+
+            with job.changed:
+                status = job.view["status"]
+                if status in ("error", "cancelled"):
+                    return
+                if status != "done":
+                    job.changed.wait(STREAM_POLL_SECONDS)
+                    continue
+
+            # Complete: the open handle survives the rename, drain it
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+    except GeneratorExit:
+        # Client went away mid-stream
+        if job.status != "done":
+            cancel_token(token)
+        raise
+    finally:
+        if f:
+            f.close()
+
+
+def publish_job(job, path):
+    # Move a finished file into the cache and hand it to every waiting token
+    final_path = job.key
+    os.replace(path, final_path)
+    size = os.path.getsize(final_path)
+
+    pinned = STATE.pinned_files()
+    with LOCK:
+        release_attempt(job)
+        if job.remote:
+            # Taken over meanwhile (see disown_job); refresh_followed finds
+            # the file and finishes this copy
+            return
+        forget_job(job)
+        with job.changed:
+            job.status = "done"
+            job.percent = 100.0
+            job.downloaded_bytes = job.total_bytes = size
+        job.file = final_path
+        tokens = list(job.tokens)
+        for token in tokens:
+            acquire_file(final_path)
+        mark_changed(job)
+        evict_cache(pinned)
 
+    # Tokens expire on their own; the file stays until evicted
+    for token in tokens:
+        schedule_token_expire(token, TOKEN_EXPIRE_SECONDS)
 
-def schedule_token_expire(token, delay):
-    def worker():
-        time.sleep(delay)
-        with LOCK:
-            DOWNLOADS.pop(token, None)
-    threading.Thread(target=worker, daemon=True).start()
 
+def remove_partials(job):
+    # Everything a job writes before publishing starts with its partial stem
+    prefix = os.path.basename(os.path.splitext(job.partial)[0]) + "."
+    for name in os.listdir(DOWNLOAD_DIR):
+        if name.startswith(prefix):
+            try:
+                os.remove(os.path.join(DOWNLOAD_DIR, name))
+            except OSError:
+                pass
 
-def build_format(res, audio, fmt):
-    video_ext = "mp4" if fmt == "mp4" else "webm"
-    audio_ext = "m4a" if fmt == "mp4" else "webm"
 
-    video = f"bestvideo[ext={video_ext}]"
-    if res:
-        video += f"[height<={res}]"
+def release_attempt(job):
+    # Caller must hold LOCK. Its worker is done, so its partial name is free again.
+    attempts = ABANDONED.get(job.key)
+    if attempts is not None:
+        attempts.discard(job.attempt)
+        if not attempts:
+            del ABANDONED[job.key]
 
-    audio_part = f"bestaudio[ext={audio_ext}][abr<={audio}]"
-    return f"{video}+{audio_part}/best"
 
+def fail_job(job, error):
+    # Also covers cancelled jobs: a truncated file is never left to be
+    # mistaken for a finished one. Only this attempt's files go; a retry
+    # after the watchdog gave up on it writes under another name. A job
+    # another process took over keeps them, as that process resumes from
+    # them (see disown_job).
+    if not job.remote:
+        remove_partials(job)
 
-# =========================
-# Download Worker
-# =========================
+    with LOCK:
+        release_attempt(job)
+        if job.status in FINISHED or job.remote:
+            return
+        forget_job(job)
+        if job.cancelled:
+            job.status = "cancelled"
+            job.error = job.cancelled
+        else:
+            job.status = "error"
+            job.error = str(error)
+        tokens = list(job.tokens)
+        JOURNAL.record("failed", tokens=tokens, status=job.status, error=job.error)
+        mark_changed(job)
 
-def download_worker(token, video_id, res, audio, fmt, ip):
-    url = f"https://www.youtube.com/watch?v={video_id}"
-    output_path = os.path.join(DOWNLOAD_DIR, f"{token}.{fmt}")
+    for token in tokens:
+        schedule_token_expire(token, token_lifetime(job.status))
 
-    def progress_hook(d):
-        with LOCK:
-            info = DOWNLOADS.get(token)
-            if not info:
-                return
 
-            if d["status"] == "downloading":
-                total = d.get("total_bytes") or d.get("total_bytes_estimate")
-                downloaded = d.get("downloaded_bytes", 0)
-
-                info.update({
-                    "status": "downloading",
-                    "downloaded_bytes": downloaded,
-                    "total_bytes": total,
-                    "speed": d.get("speed"),
-                    "eta": d.get("eta"),
-                    "percent": round((downloaded / total) * 100, 2) if total else 0
-                })
-
-            elif d["status"] == "finished":
-                info["status"] = "processing"
-                info["percent"] = 100.0
-
-    ydl_opts = {
-        "format": build_format(res, audio, fmt),
-        "outtmpl": output_path,
-        "merge_output_format": fmt,
-        "progress_hooks": [progress_hook],
-        "concurrent_fragment_downloads": 8,
+def ydl_options(**overrides):
+    opts = {
         "retries": 10,
         "fragment_retries": 10,
         "quiet": True,
@@ -144,25 +1878,409 @@ def download_worker(token, video_id, res, audio, fmt, ip):
             }
         },
     }
+    opts.update(overrides)
+    return opts
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+
+PROGRESS_KEYS = ("status", "downloaded_bytes", "total_bytes", "total_bytes_estimate",
+                 "speed", "eta")
+
+
+class ProgressThrottle:
+    """Coalesces the progress reports of one job before they are published.
+
+    yt-dlp reports every chunk, from all fragment threads. At most max_hz
+    reports a second of the same status are passed on to publish(); in
+    between, the newest is held back. It is passed on just before a report
+    with another status, by the next report once the interval is up, or,
+    given a scheduler, once the interval is up even if no report comes.
+    close() passes on whatever is still held when the download is over.
+    """
+
+    def __init__(self, publish, max_hz, scheduler=None):
+        self._publish = publish
+        self._interval = 1.0 / max_hz
+        self._scheduler = scheduler
+        # Held while publishing too, so reports go out in order
+        self._lock = threading.Lock()
+        self._status = None
+        self._published_at = 0.0
+        self._pending = None
+        self._scheduled = False
+        self._closed = False
+
+    def __call__(self, d):
+        with self._lock:
+            if self._closed:
+                return
+            if d["status"] == self._status:
+                wait = self._published_at + self._interval - time.monotonic()
+                if wait > 0:
+                    self._pending = d
+                    if self._scheduler and not self._scheduled:
+                        self._scheduled = True
+                        self._scheduler.schedule(("progress", id(self)), wait, self._flush)
+                    return
+            elif self._pending is not None:
+                self._send(self._pending)
+            self._send(d)
+
+    def close(self):
+        """Pass on a held report; nothing is published once this returns."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._scheduled:
+                self._scheduler.cancel(("progress", id(self)))
+            self._send_quietly()
+
+    def _send(self, d):
+        # Caller holds self._lock
+        self._pending = None
+        self._status = d["status"]
+        self._published_at = time.monotonic()
+        self._publish(d)
+
+    def _send_quietly(self):
+        # Caller holds self._lock. Off the download's own thread, or after
+        # it ended, a cancelled job's JobCancelled has nowhere to go.
+        if self._pending is not None:
+            try:
+                self._send(self._pending)
+            except JobCancelled:
+                pass
+
+    def _flush(self):
+        # Runs on the scheduler thread
+        with self._lock:
+            self._scheduled = False
+            if self._closed or self._pending is None:
+                return
+            wait = self._published_at + self._interval - time.monotonic()
+            if wait > 0:
+                # Something went out since this was scheduled
+                self._scheduled = True
+                self._scheduler.schedule(("progress", id(self)), wait, self._flush)
+                return
+            self._send_quietly()
+
+
+def apply_progress(job, d):
+    # Only takes the job's own lock, so downloads don't hold up the API
+    with job.changed:
+        if job.cancelled:
+            raise JobCancelled(job.cancelled)
+
+        if d["status"] == "downloading":
+            total = d.get("total_bytes") or d.get("total_bytes_estimate")
+            downloaded = d.get("downloaded_bytes", 0)
+            if downloaded != job.downloaded_bytes:
+                job.progress_at = time.time()
+
+            job.status = "downloading"
+            job.downloaded_bytes = downloaded
+            job.total_bytes = total
+            job.speed = d.get("speed")
+            job.eta = d.get("eta")
+            job.percent = round((downloaded / total) * 100, 2) if total else 0
+
+        elif d["status"] == "finished":
+            total = d.get("total_bytes") or job.total_bytes
+            job.status = "processing"
+            job.percent = 100.0
+            if total:
+                job.downloaded_bytes = job.total_bytes = total
+            job.progress_at = time.time()
+
+        mark_changed(job)
+
+
+def fetch_media(spec, progress_hook, bucket):
+    # Runs yt-dlp for one job and returns the downloaded file paths. Only
+    # uses its arguments, so it can run in a worker process as well.
+    url = f"https://www.youtube.com/watch?v={spec['video_id']}"
+    common = {
+        "progress_hooks": [progress_hook, bucket.progress_hook()],
+        "concurrent_fragment_downloads": spec["fragments"],
+    }
+
+    if spec["stream"]:
+        # Single progressive file, nothing to merge. Written without a
+        # .part file so stream_growing_file can follow it.
+        opts = ydl_options(format=spec["format_string"], outtmpl=spec["partial"],
+                           nopart=True, **common)
+        with yt_dlp.YoutubeDL(opts) as ydl:
             ydl.download([url])
+        return [spec["partial"]]
 
-        with LOCK:
-            if token in DOWNLOADS:
-                DOWNLOADS[token]["status"] = "done"
-                DOWNLOADS[token]["file"] = output_path
+    # Resolve video+audio with the usual selector, then download those
+    # formats as separate files instead of letting yt-dlp merge them here
+    with yt_dlp.YoutubeDL(ydl_options(format=spec["format_string"])) as ydl:
+        info = ydl.extract_info(url, download=False)
+    selected = info.get("requested_formats") or [info]
 
-        # Schedule cleanup - file deleted after token expires
-        schedule_token_expire(token, TOKEN_EXPIRE_SECONDS)
-        schedule_delete(output_path, FILE_DELETE_SECONDS)
+    stem = os.path.splitext(spec["partial"])[0]
+    opts = ydl_options(format=",".join(f["format_id"] for f in selected),
+                       outtmpl=f"{stem}.f%(format_id)s.%(ext)s", **common)
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        result = ydl.process_ie_result(info, download=True)
+    return [d["filepath"] for d in result.get("requested_downloads", [])]
+
+
+def download_worker(job):
+    # Network stage: fetch the selected streams, then hand them to the merge
+    # pool so this slot is free for the next download straight away
+    spec = {
+        "video_id": job.video_id,
+        "format_string": job.format_string,
+        "partial": job.partial,
+        "stream": job.stream,
+        "fragments": CONCURRENCY["fragments"],
+    }
+    on_progress = functools.partial(apply_progress, job)
+    started = time.time()
+    with LOCK:
+        job.fetch_started = job.progress_at = started
+
+    SHAPER.job_started()
+    try:
+        if WORKER_MODE == "process":
+            files = PROCESS_POOL.run(spec, on_progress, lambda: job.cancelled)
+        else:
+            # Worker processes coalesce their reports before sending them
+            throttle = ProgressThrottle(on_progress, PROGRESS_PUBLISH_HZ, SCHEDULER)
+            try:
+                files = fetch_media(spec, throttle, TokenBucket(SHAPER.share))
+            finally:
+                throttle.close()
+    except Exception as e:
+        fail_job(job, e)
+        return
+    finally:
+        SHAPER.job_finished()
+
+    with LOCK:
+        job.fetch_started = None
+        JOB_DURATIONS.append(time.time() - started)
+
+    if job.stream:
+        try:
+            if job.cancelled:
+                raise JobCancelled(job.cancelled)
+            publish_job(job, files[0])
+        except Exception as e:
+            fail_job(job, e)
+    else:
+        merge_executor.submit(merge_worker, job, files)
+
+
+def merge_worker(job, files):
+    # CPU/disk stage: mux the separate streams (or just publish a single file)
+    try:
+        if job.cancelled:
+            raise JobCancelled(job.cancelled)
+        if len(files) == 1:
+            publish_job(job, files[0])
+            return
 
+        merged = job.partial
+        subprocess.run(
+            [FFMPEG_PATH, "-y", "-loglevel", "error"]
+            + [arg for path in files for arg in ("-i", path)]
+            + [arg for i in range(len(files)) for arg in ("-map", str(i))]
+            + ["-c", "copy", merged],
+            check=True, capture_output=True
+        )
+        for path in files:
+            os.remove(path)
+        publish_job(job, merged)
+
+    except subprocess.CalledProcessError as e:
+        fail_job(job, e.stderr.decode(errors="replace").strip() or e)
     except Exception as e:
+        fail_job(job, e)
+
+
+def job_overdue(job, now):
+    # Why a download in its network stage should be given up on, if it should
+    if not job.fetch_started:
+        return None
+    if now - job.progress_at > STALL_TIMEOUT_SECONDS:
+        return f"Download stalled: no progress for {STALL_TIMEOUT_SECONDS} seconds"
+    deadline = JOB_DEADLINE_SECONDS + (job.total_bytes or 0) / JOB_MIN_BYTES_PER_SEC
+    if now - job.fetch_started > deadline:
+        return f"Download took longer than its {int(deadline)} second deadline"
+    return None
+
+
+def watch_jobs():
+    # Fail stuck downloads so they stop holding a slot. A worker process is
+    # killed once it ignores the cancel; a stuck thread is left behind and
+    # its slot handed to a fresh one.
+    try:
+        now = time.time()
+        failed = []
         with LOCK:
-            if token in DOWNLOADS:
-                DOWNLOADS[token]["status"] = "error"
-                DOWNLOADS[token]["error"] = str(e)
+            for job in list(JOBS.values()) + list(STOPPING):
+                reason = job_overdue(job, now)
+                if not reason:
+                    continue
+                app.logger.warning("Aborting %s: %s", job.key, reason)
+                with job.changed:   # its progress hook may be running
+                    job.cancelled = reason
+                    job.status = "error"
+                    job.error = reason
+                    job.fetch_started = None
+                forget_job(job)
+                # Its worker can go on writing for a while; see Job.partial
+                ABANDONED.setdefault(job.key, set()).add(job.attempt)
+                JOURNAL.record("failed", tokens=list(job.tokens), status="error", error=reason)
+                mark_changed(job)
+                failed.extend(job.tokens)
+                if WORKER_MODE != "process":
+                    executor.abandon(job.ticket)
+
+        for token in failed:
+            schedule_token_expire(token, FAILED_TOKEN_EXPIRE_SECONDS)
+    finally:
+        SCHEDULER.schedule(("watchdog", "jobs"), WATCHDOG_SECONDS, watch_jobs)
+
+# =========================
+# Worker Processes
+# =========================
+
+def process_worker_main(conn, cancel_event, share):
+    # Entry point of a worker process: run jobs sent by the parent and
+    # stream their progress back over the pipe
+    import resource
+
+    send_lock = threading.Lock()   # yt-dlp may report from several threads
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def progress_hook(d):
+        if cancel_event.is_set():
+            raise JobCancelled("Cancelled")
+        throttle(d)
+
+    jobs = 0
+    while True:
+        try:
+            spec = conn.recv()
+        except EOFError:
+            return
+        cancel_event.clear()
+        # No scheduler here: a held report goes out with the next one, or
+        # from close() before the result
+        throttle = ProgressThrottle(
+            lambda d: send(("progress", {k: d.get(k) for k in PROGRESS_KEYS})),
+            PROGRESS_PUBLISH_HZ)
+
+        try:
+            bucket = TokenBucket(lambda: share.value)
+            result = ("done", fetch_media(spec, progress_hook, bucket))
+        except Exception as e:
+            result = ("error", str(e))
+        finally:
+            throttle.close()
+
+        # ru_maxrss is in KiB on Linux
+        jobs += 1
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        retiring = jobs >= WORKER_MAX_JOBS or peak_rss > WORKER_MAX_RSS_BYTES
+        send(result + (retiring,))
+        if retiring:
+            return
+
+
+class ProcessPool:
+    """Long-lived yt-dlp worker processes, started on demand.
+
+    The calling thread (a FairExecutor worker) hands one job to an idle
+    process and relays its progress events until it reports back, so slot
+    accounting stays in FairExecutor.
+    """
+
+    def __init__(self):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._idle = []   # (process, connection, cancel event)
+        self.stats = {"spawned": 0, "retired": 0, "crashed": 0, "busy": 0}
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        cancel_event = self._ctx.Event()
+        process = self._ctx.Process(target=process_worker_main,
+                                    args=(child_conn, cancel_event, SHAPER.shared_share),
+                                    daemon=True)
+        process.start()
+        child_conn.close()
+        self.stats["spawned"] += 1
+        return process, parent_conn, cancel_event
+
+    def run(self, spec, on_progress, cancelled):
+        with self._lock:
+            worker = self._idle.pop() if self._idle else self._spawn()
+            self.stats["busy"] += 1
+
+        process, conn, cancel_event = worker
+        keep = False
+        cancel_sent = None
+        try:
+            conn.send(spec)
+            while True:
+                # Wake up now and then to pass a cancellation on to the
+                # worker, and to kill it if it is too stuck to notice
+                if not conn.poll(1):
+                    if not cancelled():
+                        continue
+                    if cancel_sent is None:
+                        cancel_event.set()
+                        cancel_sent = time.monotonic()
+                    elif time.monotonic() - cancel_sent > WORKER_CANCEL_GRACE_SECONDS:
+                        process.kill()
+                    continue
+                try:
+                    kind, payload, *rest = conn.recv()
+                except EOFError:
+                    process.join(5)
+                    with self._lock:
+                        self.stats["crashed"] += 1
+                    raise RuntimeError(f"Worker process exited (code {process.exitcode})")
+
+                if kind == "progress":
+                    try:
+                        on_progress(payload)
+                    except JobCancelled:
+                        cancel_event.set()
+                    continue
+
+                keep = not rest[0]
+                if kind == "error":
+                    raise RuntimeError(payload)
+                return payload
+        finally:
+            with self._lock:
+                self.stats["busy"] -= 1
+                if keep:
+                    self._idle.append(worker)
+                elif process.is_alive() or process.exitcode == 0:
+                    self.stats["retired"] += 1
+            if not keep:
+                conn.close()
+                process.join(5)
+                if process.is_alive():
+                    process.kill()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, idle=len(self._idle))
+
+
+PROCESS_POOL = ProcessPool()
 
 # =========================
 # Routes
@@ -172,6 +2290,7 @@ def download_worker(token, video_id, res, audio, fmt, ip):
 def watch():
     video_id = request.args.get("v")
     not_json = "not-json" in request.args
+    stream = not_json and "stream" in request.args
 
     if not video_id:
         if not_json:
@@ -179,11 +2298,6 @@ def watch():
         return jsonify({"error": "Missing v"}), 400
 
     ip = request.remote_addr
-    if not check_ip_limit(ip):
-        if not_json:
-            abort(429)
-        return jsonify({"error": "Daily limit reached"}), 429
-
     res = request.args.get("res")
     audio = request.args.get("audio", DEFAULT_AUDIO_BITRATE)
     fmt = request.args.get("format", "mp4").lower()
@@ -193,89 +2307,343 @@ def watch():
         if not_json:
             abort(400)
         return jsonify({"error": "Invalid format"}), 400
+    if stream and fmt == "webm":
+        # YouTube serves no progressive WebM; send it once it is merged
+        stream = False
 
+    if stream:
+        format_string = build_stream_format(res, fmt)
+    else:
+        format_string = build_format(res, audio, fmt)
+    cached_path = cache_path(video_id, format_string, fmt)
+
+    # Shed load before touching the quota; cache hits and requests that
+    # join a running job don't need a slot, so they are always let in
     with LOCK:
-        if token in DOWNLOADS:
-            if not_json:
-                abort(409)
-            return jsonify({"error": "Token in use"}), 409
+        needs_slot = needs_claim(cached_path)
+        retry_after = admission_retry_after() if needs_slot else None
+    if retry_after:
+        if not_json:
+            raise ServiceUnavailable(retry_after=retry_after)
+        response = jsonify({"error": "Server busy", "retry_after": retry_after})
+        response.headers["Retry-After"] = str(retry_after)
+        return response, 503
 
-        DOWNLOADS[token] = {
-            "token": token,
-            "ip": ip,
-            "video_id": video_id,
-            "format": fmt,
-            "status": "queued",
-            "percent": 0,
-            "speed": None,
-            "eta": None,
-            "downloaded_bytes": 0,
-            "total_bytes": None,
-            "started": time.time(),
-            "file": None,
-            "error": None
-        }
+    if not check_ip_limit(ip):
+        if not_json:
+            abort(429)
+        return jsonify({"error": "Daily limit reached"}), 429
+
+    attached = None
+    if not STATE.find_token(token):
+        attached = attach_tokens(ip, [(token, video_id, fmt, format_string, stream)])
+    if attached is None:
+        if not_json:
+            abort(409)
+        return jsonify({"error": "Token in use"}), 409
+    job, cached = attached[0]
+
+    if cached:
+        schedule_token_expire(token, TOKEN_EXPIRE_SECONDS)
+    else:
+        touch_token(token)
 
-    executor.submit(download_worker, token, video_id, res, audio, fmt, ip)
+    # STREAM MODE: send the file while it is still downloading. The 200 only
+    # goes out once there are bytes to send, so a job that fails before
+    # that (e.g. no single-file format) still gets an error status.
+    if stream and not cached:
+        started = wait_for_job(job, token, lambda view: (view["status"] == "done"
+                                                         or os.path.exists(job.partial)))
+        if started is None:
+            cancel_token(token)
+            return Response(status=499)
+        return Response(stream_growing_file(job, token), mimetype=f"video/{fmt}", headers={
+            "Content-Disposition": dump_options_header("attachment", {"filename": f"{token}.{fmt}"}),
+            "X-Accel-Buffering": "no"
+        })
 
     # NOT-JSON MODE: wait until done, then send file
     if not_json:
-        while True:
-            with LOCK:
-                info = DOWNLOADS.get(token)
-                if not info:
-                    abort(410)
-                if info["status"] == "done" and info["file"]:
-                    file_path = info["file"]
-            
-            # Check status outside lock to avoid holding it during file send
-            with LOCK:
-                info = DOWNLOADS.get(token)
-                if not info:
-                    abort(410)
-                if info["status"] == "done" and info["file"]:
-                    return send_file(info["file"], as_attachment=True)
-                if info["status"] == "error":
-                    abort(500)
-            
-            time.sleep(0.25)
+        view = wait_for_job(job, token, lambda view: view["status"] == "done" and view["file"])
+        if view is None:
+            # Nobody left to send the file to
+            cancel_token(token)
+            return Response(status=499)
+
+        # Send file outside the lock
+        return send_media(view["file"], f"{token}.{job.format}")
 
     # JSON MODE (default)
     return jsonify({
-        "status": "queued",
+        "status": "done" if cached else "queued",
         "token": token,
         "progress": f"/progress?token={token}",
         "download": f"/download?token={token}"
     })
 
 
+@app.route("/batch", methods=["POST"])
+def batch():
+    body = request.get_json(silent=True)
+    if isinstance(body, list):
+        body = {"items": body}
+    if not isinstance(body, dict) or not isinstance(body.get("items"), list):
+        return jsonify({"error": "Expected a JSON object with an items list"}), 400
+
+    # The batch is charged all or nothing, so more items than the daily
+    # limit could never be accepted
+    items = body["items"]
+    max_items = min(MAX_BATCH_ITEMS, MAX_DOWNLOADS_PER_DAY)
+    if not items:
+        return jsonify({"error": "Empty batch"}), 400
+    if len(items) > max_items:
+        return jsonify({"error": f"At most {max_items} items per batch"}), 400
+
+    # Each item is a video ID or an object overriding the shared options
+    plan = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {"v": item}
+        if not isinstance(item, dict) or not item.get("v"):
+            return jsonify({"error": f"Missing v in item {index}"}), 400
+
+        res = item.get("res", body.get("res"))
+        audio = item.get("audio", body.get("audio", DEFAULT_AUDIO_BITRATE))
+        fmt = str(item.get("format", body.get("format", "mp4"))).lower()
+        if fmt not in ("mp4", "webm"):
+            return jsonify({"error": f"Invalid format in item {index}"}), 400
+        plan.append((str(item["v"]), fmt, build_format(res, audio, fmt)))
+
+    ip = request.remote_addr
+    with LOCK:
+        paths = [cache_path(video_id, format_string, fmt)
+                 for video_id, fmt, format_string in plan]
+        needs_slot = any(needs_claim(path) for path in paths)
+        retry_after = admission_retry_after() if needs_slot else None
+    if retry_after:
+        response = jsonify({"error": "Server busy", "retry_after": retry_after})
+        response.headers["Retry-After"] = str(retry_after)
+        return response, 503
+
+    # Every item counts towards the daily limit, all or nothing
+    if not check_ip_limit(ip, len(plan)):
+        return jsonify({"error": "Daily limit reached"}), 429
+
+    batch_id = uuid.uuid4().hex
+    items = [(uuid.uuid4().hex, video_id, fmt, format_string, False)
+             for video_id, fmt, format_string in plan]
+    entries = []
+    finished = []
+    for (token, video_id, *_), (job, cached) in zip(items, attach_tokens(ip, items, batch_id)):
+        if cached:
+            finished.append(token)
+        entries.append({
+            "v": video_id,
+            "token": token,
+            "status": job.status,
+            "progress": f"/progress?token={token}",
+            "download": f"/download?token={token}"
+        })
+    with LOCK:
+        entry = BATCHES[batch_id] = {
+            "id": batch_id,
+            "ip": ip,
+            "tokens": [entry["token"] for entry in entries],
+            "created": time.time()
+        }
+        JOURNAL.record("batch", **entry)
+    STATE.add_batch(entry)
+
+    for token in finished:
+        schedule_token_expire(token, TOKEN_EXPIRE_SECONDS)
+    for entry in entries:
+        touch_token(entry["token"])   # nothing to do for the cached ones
+    schedule_batch_expire(batch_id)
+
+    return jsonify({
+        "batch": batch_id,
+        "progress": f"/batch/progress?id={batch_id}",
+        "items": entries
+    })
+
+
+@app.route("/batch/progress")
+def batch_progress():
+    batch_id = request.args.get("id")
+    if not batch_id:
+        return jsonify({"error": "Missing id"}), 400
+
+    ip = request.remote_addr
+    entry = BATCHES.get(batch_id)
+    local = {}
+    for token in (entry["tokens"] if entry else ()):
+        info = DOWNLOADS.get(token)
+        if info:
+            local[token] = progress_payload(info)
+    if not entry:
+        entry = STATE.find_batch(batch_id)   # created by another worker process
+    if not entry:
+        return jsonify({"error": "Invalid or expired batch"}), 404
+    if entry["ip"] != ip:
+        return jsonify({"error": "Forbidden"}), 403
+    for token in local:
+        touch_token(token)
+
+    items = []
+    for token in entry["tokens"]:
+        if token in local:
+            items.append(local[token])
+            continue
+        info = shared_info(token)
+        items.append(progress_payload(info, info["view"]) if info
+                     else {"token": token, "status": "expired"})
+
+    counts = {}
+    for item in items:
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+    done = counts.get("done", 0)
+    if all(item["status"] in FINISHED + ("expired",) for item in items):
+        status = "done" if done == len(items) else "partial" if done else "error"
+    else:
+        status = "running"
+
+    return jsonify({
+        "batch": batch_id,
+        "status": status,
+        "total": len(items),
+        "counts": counts,
+        "percent": round(sum(item.get("percent") or 0 for item in items) / len(items), 2),
+        "items": items
+    })
+
+
 @app.route("/progress")
 def progress():
     token = request.args.get("token")
     if not token:
         return jsonify({"error": "Missing token"}), 400
 
+    # Long-poll: with since=<version>, hold the request until the job moves
+    # past that version or the wait runs out
+    since = request.args.get("since", type=int)
+    wait = min(request.args.get("wait", 0, type=float), PROGRESS_MAX_WAIT_SECONDS)
+    deadline = time.time() + wait
+
+    # Reads the job's snapshot; the lock is only taken to wait for a change
     ip = request.remote_addr
-    with LOCK:
-        info = DOWNLOADS.get(token)
+    info = DOWNLOADS.get(token)
+    if info:
+        if info["ip"] != ip:
+            return jsonify({"error": "Forbidden"}), 403
+        touch_token(token)
+
+        job = info["job"]
+        view = job.view
+        if since is not None and view["version"] <= since and view["status"] not in FINISHED:
+            with job.changed:
+                while (job.view["version"] <= since and token in DOWNLOADS
+                       and time.time() < deadline):
+                    job.changed.wait(deadline - time.time())
+        if token in DOWNLOADS:
+            return jsonify(progress_payload(info))
+
+    # Not ours: another worker process may hold it. Its progress only
+    # changes once per sync, so poll at that pace.
+    while True:
+        info = shared_info(token)
         if not info:
             return jsonify({"error": "Invalid or expired token"}), 404
         if info["ip"] != ip:
             return jsonify({"error": "Forbidden"}), 403
 
-        return jsonify({
-            "token": token,
-            "status": info["status"],
-            "percent": info["percent"],
-            "speed_bps": info["speed"],
-            "eta_seconds": info["eta"],
-            "downloaded_bytes": info["downloaded_bytes"],
-            "total_bytes": info["total_bytes"],
-            "format": info["format"],
-            "elapsed": round(time.time() - info["started"], 2),
-            "ready": info["status"] == "done",
-            "error": info.get("error")
-        })
+        view = info["view"]
+        remaining = deadline - time.time()
+        if (since is None or view["version"] > since or view["status"] in FINISHED
+                or remaining <= 0):
+            return jsonify(progress_payload(info, view))
+        time.sleep(min(remaining, STATE_SYNC_SECONDS))
+
+
+@app.route("/progress/stream")
+def progress_stream():
+    token = request.args.get("token")
+    if not token:
+        return jsonify({"error": "Missing token"}), 400
+
+    ip = request.remote_addr
+    info = DOWNLOADS.get(token) or shared_info(token)
+    if not info:
+        return jsonify({"error": "Invalid or expired token"}), 404
+    if info["ip"] != ip:
+        return jsonify({"error": "Forbidden"}), 403
+
+    def stream():
+        interval = 1.0 / PROGRESS_STREAM_MAX_HZ
+        last = -1
+        last_sent = time.time()
+        while True:
+            info = DOWNLOADS.get(token)
+            if info:
+                touch_token(token)
+                payload = progress_payload(info)
+                if payload["version"] == last:
+                    job = info["job"]
+                    with job.changed:
+                        woken = (job.view["version"] != last or token not in DOWNLOADS
+                                 or job.changed.wait(PROGRESS_STREAM_KEEPALIVE))
+                    payload = None
+
+            if not info:
+                # Held by another worker process, whose progress only
+                # changes once per sync
+                info = shared_info(token)
+                if info:
+                    payload = progress_payload(info, info["view"])
+                    if payload["version"] == last:
+                        time.sleep(STATE_SYNC_SECONDS)
+                        woken = time.time() - last_sent < PROGRESS_STREAM_KEEPALIVE
+                        payload = None
+
+            if not info:
+                yield f"event: expired\ndata: {json.dumps({'error': 'Invalid or expired token'})}\n\n"
+                return
+            if payload is None:
+                # Nothing new yet; keep idle proxies from closing the connection
+                if not woken:
+                    last_sent = time.time()
+                    yield ": keepalive\n\n"
+                continue
+
+            last = payload["version"]
+            last_sent = time.time()
+            yield f"data: {json.dumps(payload)}\n\n"
+            if payload["status"] in FINISHED:
+                return
+            time.sleep(interval)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+@app.route("/cancel", methods=["POST"])
+def cancel():
+    token = request.args.get("token")
+    if not token:
+        return jsonify({"error": "Missing token"}), 400
+
+    ip = request.remote_addr
+    info = DOWNLOADS.get(token) or shared_info(token)
+    if not info:
+        return jsonify({"error": "Invalid or expired token"}), 404
+    if info["ip"] != ip:
+        return jsonify({"error": "Forbidden"}), 403
+
+    # Another process's token is cancelled by that process at its next sync
+    if not cancel_token(token):
+        STATE.request_cancel(token)
+    return jsonify({"token": token, "status": "cancelled"})
 
 
 @app.route("/download")
@@ -285,21 +2653,413 @@ def download():
         return jsonify({"error": "Missing token"}), 400
 
     ip = request.remote_addr
-    with LOCK:
-        info = DOWNLOADS.get(token)
-        if not info or info["status"] != "done":
-            return jsonify({"error": "Not ready or expired"}), 409
-        if info["ip"] != ip:
-            return jsonify({"error": "Forbidden"}), 403
+    info = DOWNLOADS.get(token)
+    if info:
+        view = info["job"].view
+    else:
+        info = shared_info(token)
+        view = info and info["view"]
+    if not info:
+        return jsonify({"error": "Not ready or expired"}), 409
+    if info["ip"] != ip:
+        return jsonify({"error": "Forbidden"}), 403
+    if view["status"] != "done":
+        # Clients may poll here until the file is ready
+        touch_token(token)
+        return jsonify({"error": "Not ready or expired"}), 409
+
+    file_path = view["file"]
+    download_name = f"{token}.{view['format']}"
 
-        file_path = info["file"]
-    
     # Send file outside the lock
-    return send_file(file_path, as_attachment=True)
+    return send_media(file_path, download_name)
+
+@app.route("/admin/stats")
+def admin_stats():
+    if request.remote_addr not in ADMIN_IPS:
+        return jsonify({"error": "Forbidden"}), 403
+
+    tracked_ips = STATE.tracked_ips()
+    with LOCK:
+        wait, average = estimated_wait()
+        return jsonify({
+            "cache": cache_stats(),
+            "concurrency": dict(CONCURRENCY,
+                                active_downloads=executor.active(),
+                                queued_downloads=executor.queued()),
+            "workers": dict(PROCESS_POOL.snapshot(), mode=WORKER_MODE),
+            "state": {
+                "backend": STATE.name,
+                "followed_jobs": len(FOLLOWED),
+                "unshared_changes": len(DIRTY)
+            },
+            "rate_limit": {
+                "tracked_ips": tracked_ips,
+                "max_ips": RATE_LIMIT_MAX_KEYS,
+                "limit": MAX_DOWNLOADS_PER_DAY,
+                "window_seconds": QUOTA_WINDOW_SECONDS
+            },
+            "bandwidth": dict(SHAPER.snapshot(),
+                              measured_bytes_per_sec=sum(j.speed or 0 for j in JOBS.values()
+                                                         if j.status == "downloading")),
+            "queue": {
+                "depth": executor.queued(),
+                "max_depth": MAX_QUEUE_DEPTH,
+                "estimated_wait_seconds": round(wait, 1),
+                "average_job_seconds": round(average, 1)
+            }
+        })
+
+# =========================
+# Recovery
+# =========================
+
+def journal_snapshot():
+    # Caller must hold LOCK and LIMITER.lock. Records that rebuild the
+    # current state.
+    records = [{"op": "quota", "ip": ip, "state": state} for ip, state in LIMITER.items()]
+    records += [dict(entry, op="batch") for entry in BATCHES.values()]
+    failed = {}
+    for info in DOWNLOADS.values():
+        records.append(dict(token_record(info), op="token"))
+        if info.get("expires"):
+            records.append({"op": "expire", "token": info["token"], "at": info["expires"]})
+        job = info["job"]
+        if job.status in ("error", "cancelled"):
+            failed[id(job)] = job
+    records += [{"op": "failed", "tokens": list(job.tokens), "status": job.status,
+                 "error": job.error} for job in failed.values()]
+    return records
+
+
+def compact_journal():
+    try:
+        with LOCK, LIMITER.lock:
+            JOURNAL.rewrite(journal_snapshot())
+            LIMITER.take_dirty()   # the snapshot has them
+    finally:
+        SCHEDULER.schedule(("journal", "compact"), JOURNAL_COMPACT_SECONDS, compact_journal)
+
+
+def flush_quota():
+    # Hits only mark the IP; its state is journaled here, off the request path
+    try:
+        with LIMITER.lock:
+            for ip, state in LIMITER.take_dirty():
+                JOURNAL.record("quota", ip=ip, state=state)
+    finally:
+        SCHEDULER.schedule(("journal", "quota"), QUOTA_JOURNAL_SECONDS, flush_quota)
+
+
+def restore_state():
+    # Rebuild tokens, batches and quota from the journal. Finished files are
+    # served from the cache again, failed jobs keep their error, and
+    # interrupted jobs are queued again to resume from their partial files.
+    JOURNAL.open()
+    tokens, quota, batches = {}, {}, {}
+    for fields in JOURNAL.replay():
+        op = fields.pop("op", None)
+        if op == "token":
+            tokens[fields["token"]] = fields
+        elif op == "expire" and fields["token"] in tokens:
+            tokens[fields["token"]]["expires"] = fields["at"]
+        elif op == "drop":
+            tokens.pop(fields["token"], None)
+        elif op == "failed":
+            for token in fields["tokens"]:
+                if token in tokens:
+                    tokens[token]["failed"] = fields
+        elif op == "quota" and "state" in fields:
+            quota[fields["ip"]] = fields["state"]
+        elif op == "batch":
+            batches[fields["id"]] = fields
+        elif op == "drop_batch":
+            batches.pop(fields["id"], None)
+
+    now = time.time()
+    expiries = []
+    for ip, state in quota.items():
+        LIMITER.load(ip, state)
+
+    with LOCK:
+        for entry in batches.values():
+            if any(token in tokens for token in entry["tokens"]):
+                BATCHES[entry["id"]] = entry
+
+        failed_jobs = {}   # id of the failure record -> job
+        for token, record in tokens.items():
+            key = record["key"]
+            expires = record.get("expires")
+            if expires and expires <= now:
+                continue
+            if os.path.exists(key):
+                job = cached_job(key, record["video_id"], record["format"],
+                                 record["format_string"])
+                expiries.append((token, (expires or now + TOKEN_EXPIRE_SECONDS) - now))
+            elif record.get("failed"):
+                failure = record["failed"]
+                job = failed_jobs.get(id(failure))
+                if job is None:
+                    job = failed_jobs[id(failure)] = Job(
+                        key, record["video_id"], record["format"], record["format_string"])
+                    job.status = failure["status"]
+                    job.error = failure["error"]
+                    mark_changed(job)
+                expiries.append((token, (expires or now + token_lifetime(job.status)) - now))
+            elif record["stream"]:
+                continue   # the client it was streaming to is gone
+            else:
+                job = JOBS.get(key)
+                if job is None:
+                    job = JOBS[key] = Job(key, record["video_id"], record["format"],
+                                          record["format_string"])
+                    batch_id = record["batch"] if record["batch"] in BATCHES else None
+                    queue_job(job, record["ip"], batch_id)
+                expiries.append((token, (expires or now + PENDING_TOKEN_EXPIRE_SECONDS) - now))
+
+            job.tokens.add(token)
+            DOWNLOADS[token] = {
+                "token": token,
+                "ip": record["ip"],
+                "started": record["started"],
+                "batch": record["batch"],
+                "job": job
+            }
+
+        with LIMITER.lock:
+            JOURNAL.rewrite(journal_snapshot())
+
+    for token, delay in expiries:
+        schedule_token_expire(token, delay)
+    for batch_id in list(BATCHES):
+        schedule_batch_expire(batch_id)
+
+    sweep_untracked(lambda: list(JOBS))
+
+
+def sweep_untracked(busy_keys):
+    # Delete what nobody accounts for in the download directory: anything
+    # but cached files and the partial files of the jobs in busy_keys().
+    # Listing first means a job started meanwhile is already in busy_keys().
+    names = os.listdir(DOWNLOAD_DIR)
+    keep = tuple(os.path.basename(os.path.splitext(key)[0]) + ".download"
+                 for key in busy_keys())
+    for name in names:
+        path = os.path.join(DOWNLOAD_DIR, name)
+        if CACHE_FILE_RE.match(name) or name.startswith(keep) or not os.path.isfile(path):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# =========================
+# Shared State
+# =========================
+
+def sync_state():
+    # Share this process's job progress, follow the jobs other processes
+    # run for our tokens, act on cancels sent to other processes, and take
+    # over jobs whose process died
+    try:
+        # mark_changed adds to DIRTY without LOCK, so take entries one by one
+        dirty = {}
+        for key in list(DIRTY):
+            job = DIRTY.pop(key, None)
+            if job is not None:
+                dirty[key] = job
+        views = {key: current_view(job) for key, job in dirty.items()}
+        with LOCK:
+            followed = list(FOLLOWED.items())
+        try:
+            lost = STATE.publish(views)
+        except Exception:
+            for key, job in dirty.items():
+                DIRTY.setdefault(key, job)
+            raise
+
+        for key in lost:
+            disown_job(dirty[key])
+        for token in STATE.take_cancels():
+            cancel_token(token)
+        for key, job in followed:
+            refresh_followed(key, job)
+        for key, spec in STATE.orphans():
+            adopt_job(key, spec)
+    finally:
+        SCHEDULER.schedule(("state", "sync"), STATE_SYNC_SECONDS, sync_state)
+
+
+def refresh_followed(key, job):
+    found = STATE.job(key)
+    finished = []
+    with LOCK:
+        if FOLLOWED.get(key) is not job:
+            return
+        if os.path.exists(key):
+            # Published: from here on it is an ordinary cached file
+            del FOLLOWED[key]
+            job.status = "done"
+            job.percent = 100.0
+            job.file = key
+            job.queue_position = None
+            for token in job.tokens:
+                acquire_file(key)
+            finished = list(job.tokens)
+            mark_changed(job)
+        elif found and found["view"] and found["view"]["version"] != job.remote_version:
+            view = found["view"]
+            job.status = view["status"]
+            job.percent = view["percent"]
+            job.speed = view["speed_bps"]
+            job.eta = view["eta_seconds"]
+            job.downloaded_bytes = view["downloaded_bytes"]
+            job.total_bytes = view["total_bytes"]
+            job.error = view["error"]
+            job.queue_position = view["queue_position"]
+            job.remote_version = view["version"]
+            if view["status"] in ("error", "cancelled"):
+                del FOLLOWED[key]
+                finished = list(job.tokens)
+            # Keep versions comparable with what the owner reports
+            job.version = max(job.version, view["version"] - 1)
+            mark_changed(job)
+        orphaned = key in FOLLOWED and not (found and found["live"])
+
+    for token in finished:
+        schedule_token_expire(token, token_lifetime(job.status))
+    if orphaned:
+        adopt_job(key, {"video_id": job.video_id, "format": job.format,
+                        "format_string": job.format_string, "stream": job.stream})
+
+
+def disown_job(job):
+    # Another process adopted this job while this one was too slow to
+    # heartbeat, and runs the download now from the same partial files. Stop
+    # the local worker without touching them and follow that process's
+    # progress instead, like any job another process runs.
+    with LOCK:
+        if JOBS.get(job.key) is not job:
+            return
+        app.logger.warning("%s was taken over by another worker process", job.key)
+        del JOBS[job.key]
+        FOLLOWED[job.key] = job
+        job.remote = True
+        with job.changed:   # its progress hook may be running
+            job.cancelled = "Taken over by another worker process"
+        if job.ticket and not executor.cancel(job.ticket):
+            # Still running until its next progress report; see Job.partial
+            ABANDONED.setdefault(job.key, set()).add(job.attempt)
+        job.ticket = None
+
+
+def adopt_job(key, spec):
+    # Take over a job whose process stopped heartbeating, with the tokens it
+    # held. It resumes from the partial files like after a restart.
+    if not STATE.claim(key, spec):
+        return
+    tokens = STATE.adopt_tokens(key)
+    followers = STATE.followers(key)
+    expiries = []
+    with LOCK:
+        if key in JOBS:
+            return
+        followed = FOLLOWED.pop(key, None)
+        job = followed
+        if job is None or job.cancelled:
+            job = Job(key, spec["video_id"], spec["format"], spec["format_string"],
+                      spec["stream"])
+        if followed is not None and followed is not job:
+            # Given up by this process before (see disown_job) and its worker
+            # may still be running, so its tokens move to a fresh job
+            for token in followed.tokens:
+                DOWNLOADS[token]["job"] = job
+            job.tokens, followed.tokens = followed.tokens, set()
+        job.remote = False
+        for row in tokens:
+            if row["token"] in DOWNLOADS:
+                continue
+            job.tokens.add(row["token"])
+            DOWNLOADS[row["token"]] = {
+                "token": row["token"],
+                "ip": row["ip"],
+                "started": row["started"],
+                "batch": row["batch"],
+                "job": job
+            }
+            if row["expires"]:
+                expiries.append((row["token"], row["expires"] - time.time()))
+
+        abandoned = not job.tokens and not followers
+        if abandoned:
+            job.status = "cancelled"
+            job.error = "Cancelled"
+        else:
+            JOBS[key] = job
+            ip = DOWNLOADS[next(iter(job.tokens))]["ip"] if job.tokens else "adopted"
+            job.ticket = executor.submit(ip, download_worker, job)
+        mark_changed(job)
+
+    if abandoned:
+        remove_partials(job)
+    for token, delay in expiries:
+        schedule_token_expire(token, delay)
+
+
+def prune_state():
+    try:
+        STATE.prune()
+    finally:
+        SCHEDULER.schedule(("state", "prune"), CACHE_SWEEP_SECONDS, prune_state)
+
+# =========================
+# Startup
+# =========================
+
+SERVICES_LOCK = threading.Lock()
+SERVICES_STARTED = threading.Event()
+
+
+def start_background():
+    # Starts the scheduler, the download workers and the periodic tasks and
+    # restores the state, once per process. Importing the module does none
+    # of this (tests, worker processes and a preloading server master import
+    # it too); it happens on the first request, or earlier from __main__ or
+    # a server hook such as gunicorn's post_worker_init.
+    with SERVICES_LOCK:
+        if SERVICES_STARTED.is_set():
+            return
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        SCHEDULER.start()
+        executor.start()
+        if STATE.shared:
+            # The database is the durable record; sync_state takes over jobs
+            # left behind by processes that are gone
+            sweep_untracked(STATE.unfinished_keys)
+            SCHEDULER.schedule(("state", "sync"), 0, sync_state)
+            SCHEDULER.schedule(("state", "prune"), CACHE_SWEEP_SECONDS, prune_state)
+        else:
+            restore_state()
+            SCHEDULER.schedule(("journal", "compact"), JOURNAL_COMPACT_SECONDS,
+                               compact_journal)
+            SCHEDULER.schedule(("journal", "quota"), QUOTA_JOURNAL_SECONDS, flush_quota)
+        load_cache()
+        SCHEDULER.schedule(("watchdog", "jobs"), WATCHDOG_SECONDS, watch_jobs)
+        if ADAPTIVE_CONCURRENCY:
+            SCHEDULER.schedule(("concurrency", "adjust"), CONCURRENCY_ADJUST_SECONDS,
+                               adjust_concurrency)
+        SERVICES_STARTED.set()
+
+
+@app.before_request
+def ensure_started():
+    if not SERVICES_STARTED.is_set():
+        start_background()
 
 # =========================
 # Main
 # =========================
 
 if __name__ == "__main__":
+    start_background()
     app.run(host=HOST, port=PORT)
@@ -0,0 +1,88 @@
+import os
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeYouTube:
+    """Stands in for fetch_media: writes SIZE bytes to the partial file,
+    reporting progress on the way. A video held with hold() stays half done
+    until release(), still reporting, so a cancel stops it as it would a
+    real download.
+    """
+
+    SIZE = 1000
+
+    def __init__(self):
+        self.gates = {}
+        self.fetched = []
+
+    def hold(self, video_id):
+        self.gates[video_id] = threading.Event()
+
+    def release(self, video_id):
+        self.gates[video_id].set()
+
+    def __call__(self, spec, progress_hook, bucket):
+        self.fetched.append(spec["video_id"])
+        half = {"status": "downloading", "downloaded_bytes": self.SIZE // 2,
+                "total_bytes": self.SIZE}
+        with open(spec["partial"], "wb") as f:
+            f.write(b"x" * (self.SIZE // 2))
+        progress_hook(half)
+        gate = self.gates.get(spec["video_id"])
+        while gate and not gate.wait(0.02):
+            progress_hook(half)
+        with open(spec["partial"], "ab") as f:
+            f.write(b"x" * (self.SIZE - self.SIZE // 2))
+        progress_hook({"status": "finished", "downloaded_bytes": self.SIZE,
+                       "total_bytes": self.SIZE})
+        return [spec["partial"]]
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # The services start once per test run; each test gets a fresh working
+    # directory, which is where the downloads go
+    import app
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(app.DOWNLOAD_DIR)
+    app.start_background()
+    monkeypatch.setattr(app.LIMITER, "limit", 10_000)
+    return app
+
+
+@pytest.fixture
+def youtube(server, monkeypatch):
+    fake = FakeYouTube()
+    monkeypatch.setattr(server, "fetch_media", fake)
+    yield fake
+    for gate in fake.gates.values():
+        gate.set()
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+@pytest.fixture
+def video_id():
+    # Jobs and cached files outlive a test, so every test asks for new videos
+    return lambda: uuid.uuid4().hex[:11]
+
+
+@pytest.fixture
+def wait_until():
+    def wait(predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            assert time.time() < deadline, "timed out"
+            time.sleep(0.01)
+    return wait
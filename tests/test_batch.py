@@ -0,0 +1,56 @@
+import pytest
+
+
+def test_batch_progress_until_done(server, client, youtube, video_id, wait_until):
+    first, second = video_id(), video_id()
+    youtube.hold(first)
+    body = client.post("/batch", json={"items": [first, {"v": second, "format": "webm"},
+                                                 first]}).json
+    tokens = [item["token"] for item in body["items"]]
+    assert [item["v"] for item in body["items"]] == [first, second, first]
+    assert server.DOWNLOADS[tokens[0]]["job"] is server.DOWNLOADS[tokens[2]]["job"]
+    assert server.DOWNLOADS[tokens[1]]["job"].format == "webm"
+
+    wait_until(lambda: client.get(body["progress"]).json["counts"].get("done") == 1)
+    progress = client.get(body["progress"]).json
+    assert progress["status"] == "running" and progress["total"] == 3
+
+    youtube.release(first)
+    wait_until(lambda: client.get(body["progress"]).json["status"] == "done")
+    assert client.get(body["progress"]).json["percent"] == 100
+    assert youtube.fetched.count(first) == 1
+    assert client.get(body["items"][0]["download"]).status_code == 200
+
+
+def test_batch_belongs_to_its_client(client, youtube, video_id):
+    body = client.post("/batch", json=[video_id()]).json
+    response = client.get(body["progress"], environ_base={"REMOTE_ADDR": "10.0.11.9"})
+    assert response.status_code == 403
+    assert client.get("/batch/progress?id=nope").status_code == 404
+
+
+@pytest.mark.parametrize("body", [
+    {},
+    {"items": []},
+    {"items": [{"res": 720}]},
+    {"items": ["x"], "format": "avi"},
+])
+def test_rejects_bad_batches(client, youtube, body):
+    assert client.post("/batch", json=body).status_code == 400
+    assert youtube.fetched == []
+
+
+def test_rejects_more_items_than_the_daily_limit(server, client, youtube):
+    # Such a batch could never be charged in full
+    items = ["x"] * (min(server.MAX_BATCH_ITEMS, server.MAX_DOWNLOADS_PER_DAY) + 1)
+    assert client.post("/batch", json=items).status_code == 400
+
+
+def test_batch_over_the_daily_limit_queues_nothing(server, client, youtube, video_id,
+                                                   monkeypatch):
+    monkeypatch.setattr(server.LIMITER, "limit", 2)
+    ip = {"REMOTE_ADDR": "10.0.11.10"}
+    response = client.post("/batch", json=[video_id() for _ in range(3)], environ_base=ip)
+    assert response.status_code == 429
+    assert client.post("/batch", json=[video_id() for _ in range(2)],
+                       environ_base=ip).status_code == 200
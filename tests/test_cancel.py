@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+
+@pytest.mark.parametrize("how", ["cancel", "expiry"])
+def test_new_token_does_not_join_a_cancelled_job(server, client, youtube, video_id,
+                                                 wait_until, how):
+    vid = video_id()
+    youtube.hold(vid)
+    first = client.get(f"/watch?v={vid}").json["token"]
+    job = server.DOWNLOADS[first]["job"]
+    wait_until(lambda: job.status == "downloading")
+
+    if how == "cancel":
+        assert client.post(f"/cancel?token={first}").json["status"] == "cancelled"
+    else:
+        server.expire_token(first)
+    second = client.get(f"/watch?v={vid}").json["token"]
+    assert server.DOWNLOADS[second]["job"] is not job
+
+    youtube.release(vid)
+    wait_until(lambda: client.get(f"/progress?token={second}").json["status"] == "done")
+    assert job.status == "cancelled"
+    with open(server.DOWNLOADS[second]["job"].file, "rb") as f:
+        assert len(f.read()) == youtube.SIZE
+
+
+def test_cancelling_a_queued_job_removes_its_partial_files(server, client, youtube,
+                                                           video_id, wait_until):
+    ip = {"REMOTE_ADDR": "10.0.0.15"}
+    server.executor.limit_key(ip["REMOTE_ADDR"], 1)
+    running, queued = video_id(), video_id()
+    youtube.hold(running)
+    client.get(f"/watch?v={running}", environ_base=ip)
+    token = client.get(f"/watch?v={queued}", environ_base=ip).json["token"]
+    job = server.DOWNLOADS[token]["job"]
+    assert job.status == "queued"
+
+    # As a run from before a restart would have left it
+    leftover = job.partial + ".part"
+    open(leftover, "wb").close()
+    client.post(f"/cancel?token={token}", environ_base=ip)
+    assert job.status == "cancelled"
+    wait_until(lambda: not os.path.exists(leftover))
+    wait_until(lambda: job.key not in server.ABANDONED)
@@ -0,0 +1,81 @@
+import time
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+
+def wsgi(server, path, method="GET", **query_and_headers):
+    # Runs the app as a WSGI server would, closing the body at the end
+    headers = query_and_headers.pop("headers", None)
+    environ = EnvironBuilder(path=path, method=method, query_string=query_and_headers,
+                             headers=headers,
+                             environ_base={"REMOTE_ADDR": "127.0.0.1"}).get_environ()
+    started = []
+    body = server.app(environ, lambda status, headers, exc_info=None:
+                      started.append((status, dict(headers))))
+    try:
+        data = b"".join(body)
+    finally:
+        body.close()
+    status, headers = started[0]
+    return int(status.split()[0]), headers, data
+
+
+@pytest.fixture
+def cached_token(server, client, video_id):
+    # A token for a video already in the cache
+    vid = video_id()
+    path = server.cache_path(vid, server.build_format(None, server.DEFAULT_AUDIO_BITRATE, "mp4"),
+                             "mp4")
+    with open(path, "wb") as f:
+        f.write(b"0123456789")
+    response = client.get(f"/watch?v={vid}")
+    assert response.json["status"] == "done"
+    return response.json["token"], path
+
+
+@pytest.mark.parametrize("method, headers, status, body", [
+    ("GET", None, 200, b"0123456789"),
+    ("HEAD", None, 200, b""),
+    ("GET", {"Range": "bytes=2-4"}, 206, b"234"),
+])
+def test_transfer_ends_when_the_body_is_closed(server, cached_token, method, headers,
+                                               status, body):
+    token, path = cached_token
+    answer = wsgi(server, "/download", method, token=token, headers=headers)
+    assert answer[0] == status and answer[2] == body
+    assert server.CACHE[path]["transfers"] == 0
+
+
+def test_conditional_get(server, cached_token):
+    token, path = cached_token
+    status, headers, _ = wsgi(server, "/download", token=token)
+    assert status == 200
+    status, _, body = wsgi(server, "/download", token=token,
+                           headers={"If-None-Match": headers["ETag"]})
+    assert status == 304 and body == b""
+    assert server.CACHE[path]["transfers"] == 0
+
+
+def test_served_file_can_be_evicted(server, cached_token, monkeypatch):
+    token, path = cached_token
+    wsgi(server, "/download", token=token)
+    server.expire_token(token)
+    monkeypatch.setattr(server, "CACHE_MAX_BYTES", 1)
+    with server.LOCK:
+        server.evict_cache(set())
+    assert path not in server.CACHE
+
+
+def test_polling_download_keeps_a_pending_token(server, client, youtube, video_id,
+                                                 wait_until, monkeypatch):
+    monkeypatch.setattr(server, "PENDING_TOKEN_EXPIRE_SECONDS", 0.5)
+    vid = video_id()
+    youtube.hold(vid)
+    token = client.get(f"/watch?v={vid}").json["token"]
+    for _ in range(10):
+        assert client.get(f"/download?token={token}").status_code == 409
+        time.sleep(0.1)
+
+    youtube.release(vid)
+    wait_until(lambda: client.get(f"/download?token={token}").status_code == 200)
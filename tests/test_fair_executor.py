@@ -0,0 +1,147 @@
+from app import FairExecutor
+
+
+def dispatch(executor):
+    # What the worker threads would start next, without running anything
+    with executor._cond:
+        ticket = executor._next()
+    return ticket and ticket["args"][0]
+
+
+def finish(executor, key):
+    with executor._cond:
+        executor._finished(key)
+
+
+def test_round_robin_between_keys():
+    executor = FairExecutor(workers=10)
+    for name in ("a1", "a2", "a3"):
+        executor.submit("a", None, name)
+    for name in ("b1", "b2"):
+        executor.submit("b", None, name)
+    executor.submit("c", None, "c1")
+
+    order = [dispatch(executor) for _ in range(6)]
+    assert order == ["a1", "b1", "c1", "a2", "b2", "a3"]
+    assert dispatch(executor) is None
+
+
+def test_global_limit_holds_back_jobs():
+    executor = FairExecutor(workers=4, limit=1)
+    executor.submit("a", None, "a1")
+    executor.submit("b", None, "b1")
+
+    assert dispatch(executor) == "a1"
+    assert dispatch(executor) is None
+    finish(executor, "a")
+    assert dispatch(executor) == "b1"
+
+
+def test_key_limit_skips_capped_key():
+    executor = FairExecutor(workers=10)
+    executor.limit_key("batch", 1)
+    for name in ("x1", "x2", "x3"):
+        executor.submit("batch", None, name)
+    executor.submit("other", None, "o1")
+    executor.submit("other", None, "o2")
+
+    assert [dispatch(executor) for _ in range(3)] == ["x1", "o1", "o2"]
+    assert dispatch(executor) is None
+    finish(executor, "batch")
+    assert dispatch(executor) == "x2"
+
+
+def test_key_limit_dropped_when_key_is_idle():
+    executor = FairExecutor(workers=10)
+    executor.limit_key("batch", 1)
+    executor.submit("batch", None, "x1")
+
+    assert dispatch(executor) == "x1"
+    finish(executor, "batch")
+    assert executor._key_limits == {}
+
+
+def test_position_matches_dispatch_order():
+    executor = FairExecutor(workers=10)
+    tickets = [executor.submit(key, None, f"{key}{n}")
+               for key, count in (("a", 3), ("b", 2), ("c", 1)) for n in range(count)]
+    positions = {t["args"][0]: executor.position(t) for t in tickets}
+
+    order = [dispatch(executor) for _ in range(len(tickets))]
+    assert sorted(positions, key=positions.get) == order
+    assert sorted(positions.values()) == list(range(1, len(tickets) + 1))
+
+
+def test_position_with_key_limit():
+    executor = FairExecutor(workers=10)
+    executor.limit_key("batch", 1)
+    x1 = executor.submit("batch", None, "x1")
+    x2 = executor.submit("batch", None, "x2")
+    o1 = executor.submit("other", None, "o1")
+    o2 = executor.submit("other", None, "o2")
+
+    assert dispatch(executor) == "x1"
+    # The capped batch is passed over until x1 is done
+    assert executor.position(o1) == 1
+    assert executor.position(o2) == 2
+    assert executor.position(x2) == 3
+    assert executor.position(x1) is None
+
+
+def test_cancel_removes_ticket_and_idle_key_limit():
+    executor = FairExecutor(workers=10)
+    executor.limit_key("batch", 1)
+    ticket = executor.submit("batch", None, "x1")
+    other = executor.submit("other", None, "o1")
+
+    assert executor.cancel(ticket)
+    assert not executor.cancel(ticket)
+    assert executor._key_limits == {}
+    assert executor.position(other) == 1
+    assert dispatch(executor) == "o1"
+    assert not executor.cancel(other)
+
+
+def test_keys_of_a_group_share_its_turn():
+    executor = FairExecutor(workers=10)
+    for name in ("s1", "s2"):
+        executor.submit("a", None, name, group="a")
+    for batch in ("x", "y"):
+        for n in (1, 2):
+            executor.submit(("a", batch), None, f"{batch}{n}", group="a")
+    for name in ("b1", "b2", "b3"):
+        executor.submit("b", None, name)
+
+    order = [dispatch(executor) for _ in range(9)]
+    assert order == ["s1", "b1", "x1", "b2", "y1", "b3", "s2", "x2", "y2"]
+
+
+def test_key_limit_within_a_group():
+    executor = FairExecutor(workers=10)
+    executor.limit_key(("a", "x"), 1)
+    for name in ("x1", "x2"):
+        executor.submit(("a", "x"), None, name, group="a")
+    executor.submit("a", None, "s1", group="a")
+    executor.submit("b", None, "b1")
+
+    assert [dispatch(executor) for _ in range(3)] == ["x1", "b1", "s1"]
+    assert dispatch(executor) is None
+    finish(executor, ("a", "x"))
+    assert dispatch(executor) == "x2"
+
+
+def test_position_matches_dispatch_order_with_groups():
+    executor = FairExecutor(workers=10)
+    executor.limit_key(("a", "x"), 1)
+    tickets = [executor.submit(key, None, f"{key}{n}", group=key[0])
+               for key, count in ((("a", "x"), 3), ("a", 2), ("b", 2)) for n in range(count)]
+    positions = {t["args"][0]: executor.position(t) for t in tickets}
+
+    order = []
+    while len(order) < len(tickets):
+        name = dispatch(executor)
+        if name is None:
+            finish(executor, ("a", "x"))
+            continue
+        order.append(name)
+    assert sorted(positions, key=positions.get) == order
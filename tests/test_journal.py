@@ -0,0 +1,48 @@
+import time
+
+from app import Journal
+
+
+def replayed(journal, count):
+    # The writer thread appends in the background
+    deadline = time.time() + 2
+    while True:
+        records = list(journal.replay())
+        if len(records) >= count or time.time() > deadline:
+            return records
+        time.sleep(0.01)
+
+
+def test_records_are_written_in_order(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    journal.open()
+    for n in range(100):
+        journal.record("token", n=n)
+
+    assert [r["n"] for r in replayed(journal, 100)] == list(range(100))
+
+
+def test_records_before_open_are_dropped(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    journal.record("token", n=0)
+    journal.open()
+    journal.record("token", n=1)
+
+    assert replayed(journal, 1) == [{"n": 1, "op": "token"}]
+
+
+def test_rewrite_replaces_log_and_drops_queued_records(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    journal.open()
+    journal.record("token", n=0)
+    journal.rewrite([{"op": "snapshot"}])
+    journal.record("token", n=1)
+
+    assert replayed(journal, 2) == [{"op": "snapshot"}, {"n": 1, "op": "token"}]
+
+
+def test_truncated_line_is_skipped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    path.write_text('{"op": "token", "n": 0}\n{"op": "tok')
+
+    assert list(Journal(str(path)).replay()) == [{"op": "token", "n": 0}]
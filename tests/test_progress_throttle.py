@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from app import JobCancelled, ProgressThrottle, Scheduler
+
+
+def report(status="downloading", downloaded=0):
+    return {"status": status, "downloaded_bytes": downloaded}
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler()
+    scheduler.start()
+    return scheduler
+
+
+def test_holds_reports_within_the_interval():
+    published = []
+    throttle = ProgressThrottle(published.append, 10)
+    for n in range(5):
+        throttle(report(downloaded=n))
+    assert [d["downloaded_bytes"] for d in published] == [0]
+
+
+def test_publishes_the_newest_held_report_once_the_interval_is_up(scheduler):
+    published = []
+    throttle = ProgressThrottle(published.append, 10, scheduler)
+    for n in range(5):
+        throttle(report(downloaded=n))
+    time.sleep(0.3)
+    assert [d["downloaded_bytes"] for d in published] == [0, 4]
+
+
+def test_flushes_without_starting_threads(scheduler):
+    published = []
+    threads = threading.active_count()
+    throttle = ProgressThrottle(published.append, 50, scheduler)
+    for n in range(10):
+        throttle(report(downloaded=n))
+        assert threading.active_count() == threads
+        time.sleep(0.03)
+    throttle.close()
+    assert published[-1]["downloaded_bytes"] == 9
+
+
+def test_publishes_the_held_report_before_a_status_change():
+    published = []
+    throttle = ProgressThrottle(published.append, 1)
+    throttle(report(downloaded=1))
+    throttle(report(downloaded=2))
+    throttle(report("finished", 3))
+    assert [(d["status"], d["downloaded_bytes"]) for d in published] == [
+        ("downloading", 1), ("downloading", 2), ("finished", 3)]
+
+
+def test_next_report_after_the_interval_goes_out_at_once():
+    published = []
+    throttle = ProgressThrottle(published.append, 20)
+    throttle(report(downloaded=1))
+    throttle(report(downloaded=2))
+    time.sleep(0.1)
+    throttle(report(downloaded=3))
+    assert [d["downloaded_bytes"] for d in published] == [1, 3]
+
+
+def test_close_publishes_the_held_report_and_then_nothing(scheduler):
+    published = []
+    throttle = ProgressThrottle(published.append, 10, scheduler)
+    throttle(report(downloaded=1))
+    throttle(report(downloaded=2))
+    throttle.close()
+    throttle(report("finished", 3))
+    time.sleep(0.2)
+    assert [d["downloaded_bytes"] for d in published] == [1, 2]
+
+
+def test_cancelled_flush_is_left_to_the_next_report(scheduler):
+    # The scheduler thread can't stop the download; the hook raises it instead
+    def publish(d):
+        if d["downloaded_bytes"] > 1:
+            raise JobCancelled("Cancelled")
+
+    throttle = ProgressThrottle(publish, 10, scheduler)
+    throttle(report(downloaded=1))
+    throttle(report(downloaded=2))
+    time.sleep(0.2)
+    with pytest.raises(JobCancelled):
+        throttle(report("finished", 3))
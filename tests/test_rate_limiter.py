@@ -0,0 +1,77 @@
+import time
+
+from app import RateLimiter, sliding_window_hit
+
+
+def test_counts_within_a_window():
+    allowed, state = sliding_window_hit(None, 1000, 100, 3, 1)
+    assert allowed and state == [10, 1, 0]
+    allowed, state = sliding_window_hit(state, 1050, 100, 3, 2)
+    assert allowed and state == [10, 3, 0]
+    allowed, state = sliding_window_hit(state, 1099, 100, 3, 1)
+    assert not allowed and state == [10, 3, 0]
+
+
+def test_rollover_weights_the_previous_window():
+    state = [10, 4, 0]
+    # A quarter into window 11, three quarters of the 4 hits still count
+    allowed, state = sliding_window_hit(state, 1125, 100, 5, 3)
+    assert not allowed and state == [11, 0, 4]
+    allowed, state = sliding_window_hit(state, 1125, 100, 5, 1)
+    assert allowed and state == [11, 1, 4]
+    # Three quarters in, only one of them does
+    allowed, state = sliding_window_hit(state, 1175, 100, 5, 3)
+    assert allowed and state == [11, 4, 4]
+
+
+def test_resets_after_a_full_window_without_hits():
+    allowed, state = sliding_window_hit([10, 5, 5], 1250, 100, 5, 5)
+    assert allowed and state == [12, 5, 0]
+
+
+def test_does_not_change_the_given_state():
+    state = [10, 1, 0]
+    sliding_window_hit(state, 1010, 100, 5, 1)
+    assert state == [10, 1, 0]
+
+
+def test_charges_all_or_nothing():
+    limiter = RateLimiter(3, 3600, 100)
+    assert limiter.hit("a", 2)
+    assert not limiter.hit("a", 2)
+    assert limiter.hit("a", 1)
+    assert not limiter.hit("a")
+    assert limiter.hit("b", 3)
+
+
+def test_prunes_stale_keys():
+    limiter = RateLimiter(3, 100, 100)
+    window = int(time.time() // 100)
+    limiter.load("old", [window - 2, 1, 0])
+    limiter.load("recent", [window - 1, 1, 0])
+    limiter.hit("new")
+    assert [key for key, _ in limiter.items()] == ["recent", "new"]
+
+
+def test_drops_the_least_recently_seen_beyond_max_keys():
+    limiter = RateLimiter(3, 3600, 2)
+    limiter.hit("a")
+    limiter.hit("b")
+    limiter.hit("a")
+    limiter.hit("c")
+    assert [key for key, _ in limiter.items()] == ["a", "c"]
+    assert len(limiter) == 2
+
+
+def test_take_dirty_returns_keys_charged_since_the_last_call():
+    limiter = RateLimiter(1, 3600, 2)
+    limiter.hit("a")
+    limiter.hit("b")
+    assert not limiter.hit("a")
+    assert sorted(key for key, _ in limiter.take_dirty()) == ["a", "b"]
+    assert limiter.take_dirty() == []
+
+    limiter.hit("c")
+    limiter.hit("d")
+    limiter.hit("e")   # pushes "c" out
+    assert sorted(key for key, _ in limiter.take_dirty()) == ["d", "e"]
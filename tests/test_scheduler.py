@@ -0,0 +1,75 @@
+import threading
+import time
+
+from app import Scheduler
+
+
+def started():
+    scheduler = Scheduler()
+    scheduler.start()
+    return scheduler
+
+
+def test_runs_in_time_order():
+    scheduler = started()
+    ran = []
+    done = threading.Event()
+    scheduler.schedule("b", 0.10, lambda: ran.append("b"))
+    scheduler.schedule("a", 0.05, lambda: ran.append("a"))
+    scheduler.schedule("c", 0.15, lambda: (ran.append("c"), done.set()))
+
+    assert done.wait(2)
+    assert ran == ["a", "b", "c"]
+
+
+def test_cancel():
+    scheduler = started()
+    ran = []
+    scheduler.schedule("a", 0.05, lambda: ran.append("a"))
+    assert scheduler.pending("a")
+    assert scheduler.cancel("a")
+    assert not scheduler.cancel("a")
+    assert not scheduler.pending("a")
+
+    time.sleep(0.15)
+    assert ran == []
+
+
+def test_reschedule_moves_the_entry():
+    scheduler = started()
+    ran = []
+    done = threading.Event()
+    scheduler.schedule("a", 0.05, lambda: ran.append("first"))
+    scheduler.schedule("a", 0.20, lambda: (ran.append("second"), done.set()))
+
+    time.sleep(0.1)
+    assert ran == []
+    assert done.wait(2)
+    time.sleep(0.05)
+    assert ran == ["second"]
+
+
+def test_overdue_entries_run_in_one_go():
+    scheduler = Scheduler()
+    ran = []
+    done = threading.Event()
+    for n in range(50):
+        scheduler.schedule(n, -1 + n / 1000, lambda n=n: ran.append(n))
+    scheduler.schedule("last", 0, done.set)
+    scheduler.cancel(10)
+    scheduler.start()
+
+    assert done.wait(2)
+    assert ran == [n for n in range(50) if n != 10]
+
+
+def test_failing_task_does_not_stop_the_scheduler():
+    scheduler = started()
+    done = threading.Event()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    scheduler.schedule("fail", 0, fail)
+    scheduler.schedule("ok", 0.05, done.set)
+    assert done.wait(2)
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+
+class OwnedLock:
+    # LOCK that knows which thread holds it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owner = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.owner = threading.get_ident()
+
+    def __exit__(self, *exc):
+        self.owner = None
+        self.lock.release()
+
+
+class Watched:
+    """Wraps a backend, noting the methods called while LOCK is held."""
+
+    def __init__(self, backend, lock):
+        self.backend = backend
+        self.lock = lock
+        self.under_lock = set()
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            if self.lock.owner == threading.get_ident():
+                self.under_lock.add(name)
+            return attr(*args, **kwargs)
+        return call
+
+
+@pytest.fixture
+def state(server, monkeypatch):
+    lock = OwnedLock()
+    watched = Watched(server.STATE, lock)
+    monkeypatch.setattr(server, "LOCK", lock)
+    monkeypatch.setattr(server, "STATE", watched)
+    return watched
+
+
+def test_backend_is_not_called_under_lock(server, client, youtube, video_id, wait_until,
+                                          state):
+    vid = video_id()
+    token = client.get(f"/watch?v={vid}").json["token"]
+    other = client.get(f"/watch?v={vid}").json["token"]
+    assert client.get(f"/watch?v={video_id()}&token={token}").status_code == 409
+    batch = client.post("/batch", json=[vid, video_id()]).json
+    for t in [token] + [item["token"] for item in batch["items"]]:
+        wait_until(lambda: client.get(f"/progress?token={t}").json["status"] == "done")
+
+    client.post(f"/cancel?token={other}")
+    server.expire_token(token)
+    server.expire_batch(batch["batch"])
+    server.sweep_cache()
+    assert state.under_lock == set()
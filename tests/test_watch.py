@@ -0,0 +1,84 @@
+import pytest
+
+
+@pytest.fixture
+def one_slot(server, youtube, wait_until):
+    # One download at a time, once those of earlier tests are done
+    limit = server.executor.limit
+    wait_until(lambda: server.executor.active() == 0)
+    server.executor.set_limit(1)
+    yield
+    server.executor.set_limit(limit)
+
+
+def test_same_video_shares_one_download(server, client, youtube, video_id, wait_until):
+    vid = video_id()
+    youtube.hold(vid)
+    first = client.get(f"/watch?v={vid}").json["token"]
+    second = client.get(f"/watch?v={vid}").json["token"]
+    assert server.DOWNLOADS[first]["job"] is server.DOWNLOADS[second]["job"]
+
+    youtube.release(vid)
+    for token in (first, second):
+        wait_until(lambda: client.get(f"/progress?token={token}").json["status"] == "done")
+        assert len(client.get(f"/download?token={token}").data) == youtube.SIZE
+    assert youtube.fetched.count(vid) == 1
+
+    # Later requests are served from the cache
+    assert client.get(f"/watch?v={vid}").json["status"] == "done"
+    assert youtube.fetched.count(vid) == 1
+
+
+def test_queue_positions_take_clients_in_turn(server, client, one_slot, youtube, video_id,
+                                              wait_until):
+    a, b = {"REMOTE_ADDR": "10.0.11.1"}, {"REMOTE_ADDR": "10.0.11.2"}
+    running = video_id()
+    youtube.hold(running)
+    client.get(f"/watch?v={running}", environ_base=a)
+    wait_until(lambda: server.executor.active() == 1)
+
+    singles = [client.get(f"/watch?v={video_id()}", environ_base=a).json["token"]
+               for _ in range(2)]
+    batch = client.post("/batch", json=[video_id(), video_id()], environ_base=a).json
+    other = client.get(f"/watch?v={video_id()}", environ_base=b).json["token"]
+
+    def position(token, ip):
+        return client.get(f"/progress?token={token}", environ_base=ip).json["queue_position"]
+
+    # The batch waits for its client's turn rather than taking one of its own
+    assert position(singles[0], a) == 1
+    assert position(other, b) == 2
+    assert position(batch["items"][0]["token"], a) == 3
+    assert position(singles[1], a) == 4
+    assert position(batch["items"][1]["token"], a) == 5
+
+
+@pytest.fixture
+def busy(server, monkeypatch):
+    # No room in the queue for another download
+    monkeypatch.setattr(server, "MAX_QUEUE_DEPTH", 0)
+
+
+@pytest.mark.parametrize("not_json", [False, True])
+def test_busy_server_turns_new_downloads_away(client, youtube, video_id, busy, not_json):
+    response = client.get(f"/watch?v={video_id()}" + ("&not-json" if not_json else ""))
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    if not not_json:
+        assert response.json["retry_after"] >= 1
+    assert youtube.fetched == []
+
+
+def test_busy_server_still_serves_cache_hits_and_running_jobs(server, client, youtube,
+                                                              video_id, wait_until,
+                                                              monkeypatch):
+    cached, running = video_id(), video_id()
+    youtube.hold(running)
+    for vid, status in ((cached, "done"), (running, "downloading")):
+        token = client.get(f"/watch?v={vid}").json["token"]
+        wait_until(lambda: client.get(f"/progress?token={token}").json["status"] == status)
+
+    monkeypatch.setattr(server, "MAX_QUEUE_DEPTH", 0)
+    assert client.get(f"/watch?v={cached}").json["status"] == "done"
+    assert client.get(f"/watch?v={running}").status_code == 200
+    assert client.post("/batch", json=[video_id()]).status_code == 503